@@ -6,7 +6,12 @@ from config import Config
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_login import LoginManager
-from app.utils import get_thumbnail
+from app.utils import get_thumbnail, get_picture, thumbnail_payloads, \
+    thumbnail_queue
+from app.storage import create_storage
+from app.http_cache import add_cache_headers
+from app.cache import response_cache, identity_cache
+from app.search import search_indexer, create_search_backend, include_object
 from flask_bootstrap import Bootstrap
 from flask_mail import Mail
 
@@ -25,13 +30,22 @@ def create_app(config_class=Config):
     app.config.from_object(config_class)
 
     db.init_app(app)
-    migrate.init_app(app, db)
+    migrate.init_app(app, db, include_object=include_object)
     login.init_app(app)
     mail.init_app(app)
     bootstrap.init_app(app)
-    app.jinja_env.globals.update(get_thumbnail=get_thumbnail)
+    thumbnail_payloads.init_app(app)
+    thumbnail_queue.init_app(app)
+    response_cache.init_app(app)
+    identity_cache.init_app(app)
+    search_indexer.init_app(app)
+    app.jinja_env.globals.update(get_thumbnail=get_thumbnail,
+                                 get_picture=get_picture)
     app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']]) \
         if app.config['ELASTICSEARCH_URL'] else None
+    app.search_backend = create_search_backend(app.config)
+    app.storage = create_storage(app.config)
+    app.after_request(add_cache_headers)
 
     from app.errors import bp as errors_bp
     app.register_blueprint(errors_bp)
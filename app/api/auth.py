@@ -2,6 +2,7 @@ from flask import g
 from flask_httpauth import HTTPBasicAuth
 from app.models import User
 from app.api.errors import error_response
+from app.cache import identity_cache
 from flask_httpauth import HTTPTokenAuth
 
 
@@ -11,11 +12,20 @@ token_auth = HTTPTokenAuth()
 
 @basic_auth.verify_password
 def verify_password(username, password):
+    key = identity_cache.key('password', username or '', password or '')
+    identity = identity_cache.get(key)
+    if identity is not None:
+        g.current_user = User.from_identity(identity)
+        return True
+    generation = identity_cache.generation()
     user = User.query.filter_by(username=username).first()
     if user is None:
         return False
     g.current_user = user
-    return user.check_password(password)
+    if not user.check_password(password):
+        return False
+    identity_cache.set(key, user.identity(), generation)
+    return True
 
 
 @basic_auth.error_handler
@@ -0,0 +1,127 @@
+import math
+from datetime import datetime
+from flask import current_app, request
+from app import db
+from app.api.errors import bad_request, error_response
+from app.models import SearchableMixin, invalidate_on_commit
+from app.serializers import json_response
+
+
+def string(length, nullable=False):
+    def convert(value):
+        if value is None and nullable:
+            return None
+        if not isinstance(value, str) or not value or len(value) > length:
+            raise ValueError('must be a string of 1 to {} characters'.format(
+                length))
+        return value
+    return convert
+
+
+def number(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or \
+            not math.isfinite(value):
+        raise ValueError('must be a finite number')
+    return float(value)
+
+
+def integer(value):
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise ValueError('must be an integer')
+    return value
+
+
+def parse_updates(entries, fields):
+    if not isinstance(entries, list) or not entries:
+        raise ValueError('body must be a list of {id, changes} objects')
+    if len(entries) > current_app.config['BATCH_UPDATE_LIMIT']:
+        raise ValueError('at most {} updates per request'.format(
+            current_app.config['BATCH_UPDATE_LIMIT']))
+    updates = {}
+    for entry in entries:
+        if not isinstance(entry, dict) or \
+                not isinstance(entry.get('id'), int) or \
+                not isinstance(entry.get('changes'), dict) or \
+                not entry['changes'] or \
+                entry.get('version') is not None and \
+                not isinstance(entry['version'], int):
+            raise ValueError('each update needs an integer id, a changes '
+                             'object and optionally an integer version')
+        if entry['id'] in updates:
+            raise ValueError('id {} is updated more than once'.format(
+                entry['id']))
+        changes = {}
+        for field, value in entry['changes'].items():
+            if field not in fields:
+                raise ValueError('{} cannot be changed; use one of: {}'.format(
+                    field, ', '.join(fields)))
+            try:
+                changes[field] = fields[field](value)
+            except ValueError as e:
+                raise ValueError('{} of {}: {}'.format(field, entry['id'], e))
+        updates[entry['id']] = (changes, entry.get('version'))
+    return updates
+
+
+def batch_update(model, fields, unique=None, references=None):
+    try:
+        updates = parse_updates(request.get_json(), fields)
+    except ValueError as e:
+        return bad_request(str(e))
+    ids = list(updates)
+    current = {id: (version, value) for id, version, value in db.session.query(
+        model.id, model.version, getattr(model, unique or 'id')).filter(
+        model.id.in_(ids)).with_for_update()}
+    missing = [id for id in ids if id not in current]
+    if missing:
+        return error_response(404, 'no such ids: {}'.format(
+            ', '.join(map(str, missing))))
+    stale = [id for id, (changes, version) in updates.items()
+             if version is not None and version != current[id][0]]
+    if stale:
+        return error_response(409, 'version mismatch for ids: {}'.format(
+            ', '.join(map(str, stale))))
+    if unique:
+        renamed = {id: changes[unique] for id, (changes, _) in updates.items()
+                   if unique in changes and changes[unique] != current[id][1]}
+        values = list(renamed.values())
+        taken = [value for value, in db.session.query(
+            getattr(model, unique)).filter(getattr(model, unique).in_(values),
+                                           ~model.id.in_(list(renamed)))] \
+            if values else []
+        if taken or len(set(values)) < len(values):
+            return bad_request('please use a different {}: {}'.format(
+                unique, ', '.join(sorted(set(taken) or
+                                         {value for value in values
+                                          if values.count(value) > 1}))))
+    for field, target in (references or {}).items():
+        values = {changes[field] for changes, _ in updates.values()
+                  if field in changes}
+        known = {id for id, in db.session.query(target.id).filter(
+            target.id.in_(values))} if values else set()
+        if values - known:
+            return bad_request('unknown {}: {}'.format(
+                field, ', '.join(map(str, sorted(values - known)))))
+    # One executemany per distinct set of changed columns.
+    groups = {}
+    for id, (changes, _) in updates.items():
+        groups.setdefault(tuple(sorted(changes)), []).append(
+            dict({'new_' + field: value for field, value in changes.items()},
+                 updated_id=id))
+    table = model.__table__
+    now = datetime.utcnow()
+    for columns, params in groups.items():
+        db.session.execute(table.update().where(
+            table.c.id == db.bindparam('updated_id')).values(
+            version=table.c.version + 1, updated_at=now,
+            **{column: db.bindparam('new_' + column) for column in columns}),
+            params)
+    if issubclass(model, SearchableMixin):
+        model.bulk_changed(ids)
+    else:
+        invalidate_on_commit(model.__tablename__)
+    versions = db.session.query(model.id, model.version).filter(
+        model.id.in_(ids)).order_by(model.id).all()
+    db.session.commit()
+    return json_response({'updated': [{'id': id, 'version': version}
+                                      for id, version in versions]})
@@ -1,23 +1,59 @@
 from app.api import bp
-from flask import jsonify, request, url_for, make_response
+from flask import request, url_for, make_response
 from app.api.auth import token_auth
-from app.models import Category
+from app.models import Category, release_photo
 from app import db
+from app.api.batch import batch_update, string
 from app.api.errors import bad_request
-from app.utils import delete_photo, permission_required
+from app.http_cache import make_etag, validate
+from app.cache import cached
+from app.utils import permission_required, PHOTO_MODES
+from app.serializers import json_response
 
 
 @bp.route('/categories/<int:id>', methods=['GET'])
+@cached('category', 'item')
 def get_category(id):
-    return jsonify(Category.query.get_or_404(id).to_dict())
+    photo = request.args.get('photo', 'inline')
+    if photo not in PHOTO_MODES:
+        return bad_request('photo must be one of: ' + ', '.join(PHOTO_MODES))
+    try:
+        fields, embed = Category.parse_fields(request.args)
+    except ValueError as e:
+        return bad_request(str(e))
+    category = Category.query.options(
+        *Category.field_options(fields, embed)).get_or_404(id)
+    validate(make_etag(category.etag_parts(fields, photo), photo, fields))
+    return json_response(category.to_dict(photo=photo, fields=fields))
 
 
 @bp.route('/categories', methods=['GET'])
+@cached('category', 'item')
 def get_categories():
-    page = request.args.get('page', 1, type=int)
     per_page = min(request.args.get('per_page', 10, type=int), 100)
-    data = Category.to_collection_dict(Category.query, page, per_page, 'api.get_categories')
-    return jsonify(data)
+    photo = request.args.get('photo', 'inline')
+    if photo not in PHOTO_MODES:
+        return bad_request('photo must be one of: ' + ', '.join(PHOTO_MODES))
+    try:
+        fields, embed = Category.parse_fields(request.args)
+    except ValueError as e:
+        return bad_request(str(e))
+    query = Category.query.options(*Category.field_options(fields, embed))
+    if 'after' in request.args:
+        try:
+            data = Category.to_cursor_collection_dict(
+                query, request.args['after'], per_page,
+                'api.get_categories', sort=request.args.get('sort', 'id'),
+                with_total=request.args.get('total', 0, type=int) == 1,
+                photo=photo, fields=fields)
+        except ValueError as e:
+            return bad_request(str(e))
+        return json_response(data)
+    page = request.args.get('page', 1, type=int)
+    data = Category.to_collection_dict(query, page, per_page,
+                                       'api.get_categories', photo=photo,
+                                       fields=fields)
+    return json_response(data)
 
 
 @bp.route('/categories', methods=['POST'])
@@ -31,7 +67,7 @@ def add_category():
     category.from_dict(data)
     db.session.add(category)
     db.session.commit()
-    response = jsonify(category.to_dict())
+    response = json_response(category.to_dict())
     response.status_code = 201
     response.headers['Location'] = url_for('api.get_category', id=category.id)
     return response
@@ -48,7 +84,16 @@ def edit_category(id):
         return bad_request('please use a different name')
     category.from_dict(data)
     db.session.commit()
-    return jsonify(category.to_dict())
+    return json_response(category.to_dict())
+
+
+@bp.route('/categories', methods=['PATCH'])
+@token_auth.login_required
+@permission_required('manager')
+def patch_categories():
+    return batch_update(Category, {'name': string(64),
+                                   'description': string(512, nullable=True)},
+                        unique='name')
 
 
 @bp.route('/categories/<int:id>', methods=['DELETE'])
@@ -56,7 +101,7 @@ def edit_category(id):
 def delete_category(id):
     category = Category.query.get_or_404(id)
     if category.photo_id:
-        delete_photo(category.photo_id)
+        release_photo(category.photo_id)
     db.session.delete(category)
     db.session.commit()
     return make_response(204)
\ No newline at end of file
@@ -1,14 +1,12 @@
-from flask import jsonify
 from werkzeug.http import HTTP_STATUS_CODES
+from app.serializers import json_response
 
 
 def error_response(status_code, message=None):
     payload = {'error': HTTP_STATUS_CODES.get(status_code, 'Unknown error')}
     if message:
         payload['message'] = message
-    response = jsonify(payload)
-    response.status_code = status_code
-    return response
+    return json_response(payload, status_code)
 
 
 def bad_request(message):
@@ -1,15 +1,69 @@
+import csv
+import io
 from app.api import bp
-from flask import jsonify, request, url_for, make_response
+from flask import current_app, request, url_for, make_response, \
+    stream_with_context
 from app.api.auth import token_auth
-from app.models import Item
+from app.models import Item, Category, release_photo
 from app import db
+from app.api.batch import batch_update, integer, number, string
 from app.api.errors import bad_request
-from app.utils import delete_photo, permission_required
+from app.http_cache import make_etag, validate
+from app.cache import cached
+from app.catalog import import_rows, read_rows
+from app.utils import permission_required, PHOTO_MODES
+from app.serializers import json_response, stream_json_array, \
+    stream_json_lines
 
 
 @bp.route('/items/<int:id>', methods=['GET'])
+@cached('item', 'category')
 def get_item(id):
-    return jsonify(Item.query.get_or_404(id).to_dict())
+    photo = request.args.get('photo', 'inline')
+    if photo not in PHOTO_MODES:
+        return bad_request('photo must be one of: ' + ', '.join(PHOTO_MODES))
+    try:
+        fields, embed = Item.parse_fields(request.args)
+    except ValueError as e:
+        return bad_request(str(e))
+    item = Item.query.options(*Item.field_options(fields, embed)).get_or_404(id)
+    validate(make_etag(item.etag_parts(fields, photo), photo, fields,
+                       item.embed_parts(embed)), item.updated_at)
+    return json_response(item.to_dict(photo=photo, fields=fields,
+                                       embed=embed))
+
+
+@bp.route('/items', methods=['GET'])
+@cached('item', 'category')
+def get_items():
+    per_page = min(request.args.get('per_page', 10, type=int), 100)
+    photo = request.args.get('photo', 'inline')
+    if photo not in PHOTO_MODES:
+        return bad_request('photo must be one of: ' + ', '.join(PHOTO_MODES))
+    try:
+        fields, embed = Item.parse_fields(request.args)
+    except ValueError as e:
+        return bad_request(str(e))
+    query = Item.query.options(*Item.field_options(fields, embed))
+    filters = {}
+    if 'category_id' in request.args:
+        filters['category_id'] = request.args.get('category_id', type=int)
+        query = query.filter_by(category_id=filters['category_id'])
+    if 'after' in request.args:
+        try:
+            data = Item.to_cursor_collection_dict(
+                query, request.args['after'], per_page, 'api.get_items',
+                sort=request.args.get('sort', 'id'),
+                with_total=request.args.get('total', 0, type=int) == 1,
+                photo=photo, fields=fields, embed=embed, **filters)
+        except ValueError as e:
+            return bad_request(str(e))
+        return json_response(data)
+    page = request.args.get('page', 1, type=int)
+    data = Item.to_collection_dict(query, page, per_page, 'api.get_items',
+                                   photo=photo, fields=fields, embed=embed,
+                                   **filters)
+    return json_response(data)
 
 
 @bp.route('/items', methods=['POST'])
@@ -23,12 +77,75 @@ def add_item():
     item.from_dict(data)
     db.session.add(item)
     db.session.commit()
-    response = jsonify(item.to_dict())
+    response = json_response(item.to_dict())
     response.status_code = 201
     response.headers['Location'] = url_for('api.get_item', id=item.id)
     return response
 
 
+EXPORT_FIELDS = ['id', 'title', 'description', 'price', 'category_id',
+                 'photo_id']
+EXPORT_MIMETYPES = {'ndjson': 'application/x-ndjson', 'json': 'application/json',
+                    'csv': 'text/csv'}
+NDJSON_MIMETYPES = ('application/x-ndjson', 'application/jsonl',
+                    'application/json')
+PATCH_FIELDS = {'title': string(128), 'description': string(512, nullable=True),
+                'price': number, 'category_id': integer}
+
+
+@bp.route('/items/bulk', methods=['POST'])
+@token_auth.login_required
+@permission_required('manager')
+def import_items():
+    if request.mimetype != 'text/csv' and request.mimetype not in NDJSON_MIMETYPES:
+        return bad_request('body must be NDJSON or CSV')
+    text = io.TextIOWrapper(request.stream, encoding='utf-8', newline='')
+    created, error_count, errors = import_rows(
+        read_rows(text, request.mimetype == 'text/csv'),
+        current_app.config['ITEM_IMPORT_BATCH_SIZE'])
+    return json_response({'created': created, 'error_count': error_count,
+                          'errors': errors})
+
+
+def csv_chunks(rows, chunk_size):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+    for line_no, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if line_no % chunk_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+@bp.route('/items/export', methods=['GET'])
+@token_auth.login_required
+@permission_required('manager')
+def export_items():
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in EXPORT_MIMETYPES:
+        return bad_request('format must be one of: ' +
+                           ', '.join(EXPORT_MIMETYPES))
+    batch_size = current_app.config['ITEM_IMPORT_BATCH_SIZE']
+    query = db.session.query(*[getattr(Item, field) for field in EXPORT_FIELDS])
+    if 'category_id' in request.args:
+        query = query.filter_by(
+            category_id=request.args.get('category_id', type=int))
+
+    rows = query.order_by(Item.id).yield_per(batch_size)
+    if export_format == 'csv':
+        body = csv_chunks(rows, batch_size)
+    else:
+        stream = stream_json_array if export_format == 'json' \
+            else stream_json_lines
+        body = stream((dict(zip(EXPORT_FIELDS, row)) for row in rows),
+                      batch_size)
+    return current_app.response_class(stream_with_context(body),
+                                      mimetype=EXPORT_MIMETYPES[export_format])
+
+
 @bp.route('/items/<int:id>', methods=['PUT'])
 @token_auth.login_required
 @permission_required('manager')
@@ -40,7 +157,15 @@ def edit_item(id):
         return bad_request('please use a different title')
     item.from_dict(data)
     db.session.commit()
-    return jsonify(item.to_dict())
+    return json_response(item.to_dict())
+
+
+@bp.route('/items', methods=['PATCH'])
+@token_auth.login_required
+@permission_required('manager')
+def patch_items():
+    return batch_update(Item, PATCH_FIELDS, unique='title',
+                        references={'category_id': Category})
 
 
 @bp.route('/items/<int:id>', methods=['DELETE'])
@@ -48,7 +173,7 @@ def edit_item(id):
 def delete_item(id):
     item = Item.query.get_or_404(id)
     if item.photo_id:
-        delete_photo(item.photo_id)
+        release_photo(item.photo_id)
     db.session.delete(item)
     db.session.commit()
     return make_response(204)
\ No newline at end of file
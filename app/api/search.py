@@ -0,0 +1,59 @@
+from app.api import bp
+from flask import request, url_for
+from app.models import Item
+from app.api.errors import bad_request
+from app.search import search_filters
+from app.utils import photo_fields, PHOTO_MODES
+from app.serializers import fast_url_for, json_response
+
+
+@bp.route('/search', methods=['GET'])
+def search():
+    expression = request.args.get('q', '').strip()
+    if not expression:
+        return bad_request('q is required')
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(request.args.get('per_page', 10, type=int), 100)
+    photo = request.args.get('photo', 'url')
+    if photo not in PHOTO_MODES:
+        return bad_request('photo must be one of: ' + ', '.join(PHOTO_MODES))
+    results = Item.search(expression, page, per_page,
+                          search_filters(Item, request.args))
+    items = []
+    for hit in results['hits']:
+        # Documents indexed before a field joined the mapping lack it until
+        # the next reindex.
+        data = {field: hit.get(field) for field in
+                ('id', 'title', 'description', 'price', 'category_id')}
+        data['_links'] = {
+            'self': fast_url_for('api.get_item', id=hit['id']),
+            'category': fast_url_for('api.get_category', id=hit['category_id'])
+            if hit.get('category_id') is not None else None
+        }
+        data.update(photo_fields(hit.get('photo_id'), 120, photo))
+        items.append(data)
+    args = request.args.to_dict(flat=False)
+    args.pop('page', None)
+    return json_response({
+        'items': items,
+        'facets': results['facets'],
+        '_meta': {
+            'page': page,
+            'per_page': per_page,
+            'total_items': results['total']
+        },
+        '_links': {
+            'self': url_for('api.search', page=page, **args),
+            'next': url_for('api.search', page=page + 1, **args)
+            if results['total'] > page * per_page else None,
+            'prev': url_for('api.search', page=page - 1, **args)
+            if page > 1 else None
+        }
+    })
+
+
+@bp.route('/suggest', methods=['GET'])
+def suggest():
+    limit = min(max(request.args.get('limit', 8, type=int), 1), 20)
+    return json_response({'suggestions': Item.suggest(request.args.get('q', ''),
+                                                       limit)})
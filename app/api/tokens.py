@@ -1,7 +1,8 @@
-from flask import jsonify, g
+from flask import g
 from app import db
 from app.api import bp
 from app.api.auth import basic_auth, token_auth
+from app.serializers import json_response
 
 
 @bp.route('/tokens', methods=['POST'])
@@ -9,7 +10,7 @@ from app.api.auth import basic_auth, token_auth
 def get_token():
     token = g.current_user.get_token()
     db.session.commit()
-    return jsonify({'token': token})
+    return json_response({'token': token})
 
 
 @bp.route('/tokens', methods=['DELETE'])
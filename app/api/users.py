@@ -1,27 +1,37 @@
 from app.api import bp
-from flask import jsonify, request, url_for
+from flask import request, url_for
 from app.models import User
 from app import db
 from app.api.errors import bad_request
 from app.api.auth import token_auth
 from app.utils import permission_required
+from app.serializers import json_response
 
 
 @bp.route('/users/<int:id>', methods=['GET'])
 @token_auth.login_required
 @permission_required('admin')
 def get_user(id):
-    return jsonify(User.query.get_or_404(id).to_dict())
+    return json_response(User.query.get_or_404(id).to_dict())
 
 
 @bp.route('/users', methods=['GET'])
 @token_auth.login_required
 @permission_required('admin')
 def get_users():
-    page = request.args.get('page', 1, type=int)
     per_page = min(request.args.get('per_page', 10, type=int), 100)
+    if 'after' in request.args:
+        try:
+            data = User.to_cursor_collection_dict(
+                User.query, request.args['after'], per_page, 'api.get_users',
+                sort=request.args.get('sort', 'id'),
+                with_total=request.args.get('total', 0, type=int) == 1)
+        except ValueError as e:
+            return bad_request(str(e))
+        return json_response(data)
+    page = request.args.get('page', 1, type=int)
     data = User.to_collection_dict(User.query, page, per_page, 'api.get_users')
-    return jsonify(data)
+    return json_response(data)
 
 
 @bp.route('/users', methods=['POST'])
@@ -37,7 +47,7 @@ def create_user():
     user.from_dict(data, new_user=True)
     db.session.add(user)
     db.session.commit()
-    response = jsonify(user.to_dict())
+    response = json_response(user.to_dict())
     response.status_code = 201
     response.headers['Location'] = url_for('api.get_user', id=user.id)
     return response
@@ -57,4 +67,4 @@ def update_user(id):
         return bad_request('please use a different email address')
     user.from_dict(data, new_user=False)
     db.session.commit()
-    return jsonify(user.to_dict())
\ No newline at end of file
+    return json_response(user.to_dict())
\ No newline at end of file
@@ -0,0 +1,206 @@
+import hashlib
+import hmac
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import current_app, g, request, session
+from app.http_cache import viewer_class
+
+
+def make_key(*parts):
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+class ResponseCache(object):
+    def __init__(self):
+        self.enabled = False
+        self.max_entries = 1024
+        self.ttl = 300
+        self.redis = None
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.enabled = app.config['RESPONSE_CACHE']
+        self.max_entries = app.config['RESPONSE_CACHE_SIZE']
+        self.ttl = app.config['RESPONSE_CACHE_TTL']
+        self.redis = None
+        if app.config['REDIS_URL']:
+            try:
+                import redis
+            except ImportError:
+                raise RuntimeError('REDIS_URL is set but redis is not installed')
+            self.redis = redis.Redis.from_url(app.config['REDIS_URL'])
+        self.clear()
+
+    def generations(self, namespaces):
+        if self.redis is not None:
+            values = self.redis.mget(['cms:generation:' + namespace
+                                      for namespace in namespaces])
+            return tuple(int(value or 0) for value in values)
+        with self._lock:
+            return tuple(self._generations.get(namespace, 0)
+                         for namespace in namespaces)
+
+    def invalidate(self, *namespaces):
+        if not namespaces:
+            return
+        if self.redis is not None:
+            pipe = self.redis.pipeline()
+            for namespace in namespaces:
+                pipe.incr('cms:generation:' + namespace)
+            pipe.execute()
+        with self._lock:
+            for namespace in namespaces:
+                self._generations[namespace] = \
+                    self._generations.get(namespace, 0) + 1
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.time():
+                self._entries.move_to_end(key)
+                return entry[1]
+        if self.redis is not None:
+            value = self.redis.get('cms:cache:' + key)
+            if value is not None:
+                value = pickle.loads(value)
+                self._store(key, value)
+                return value
+        return None
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl or self.ttl
+        self._store(key, value, ttl)
+        if self.redis is not None:
+            self.redis.setex('cms:cache:' + key, ttl, pickle.dumps(value))
+
+    def _store(self, key, value, ttl=None):
+        with self._lock:
+            self._entries[key] = (time.time() + (ttl or self.ttl), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generations.clear()
+
+
+response_cache = ResponseCache()
+
+
+class IdentityCache(object):
+    def __init__(self):
+        self.max_entries = 4096
+        self.ttl = 60
+        self.secret = b''
+        self._entries = OrderedDict()
+        self._revocations = (None, 0, {})
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.max_entries = app.config['TOKEN_CACHE_SIZE']
+        self.ttl = app.config['TOKEN_CACHE_TTL']
+        self.secret = app.config['SECRET_KEY'].encode('utf-8')
+        self.clear()
+
+    def key(self, *parts):
+        return hmac.new(self.secret, '\0'.join(parts).encode('utf-8'),
+                        hashlib.sha256).digest()
+
+    def generation(self):
+        # Any committed change to a user bumps the 'user' namespace, so
+        # revoked tokens and permission changes drop every cached identity.
+        return response_cache.generations(('user',))
+
+    def get(self, key):
+        if not self.ttl:
+            return None
+        generation = self.generation()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, entry_generation, identity = entry
+            if expires <= time.time() or entry_generation != generation:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return identity
+
+    def set(self, key, identity, generation):
+        if not self.ttl:
+            return
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, generation, identity)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def revocations(self, load):
+        generation = self.generation()
+        with self._lock:
+            loaded_generation, expires, cutoffs = self._revocations
+            if loaded_generation == generation and expires > time.time():
+                return cutoffs
+        cutoffs = load()
+        with self._lock:
+            self._revocations = (generation, time.time() + self.ttl, cutoffs)
+        return cutoffs
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._revocations = (None, 0, {})
+
+
+identity_cache = IdentityCache()
+
+
+def cached(*namespaces):
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if not response_cache.enabled or request.method != 'GET' or \
+                    request.blueprint != 'api' and session.get('_flashes'):
+                return f(*args, **kwargs)
+            key = make_key(request.endpoint, sorted(kwargs.items()),
+                           sorted(request.args.items(multi=True)),
+                           request.script_root, viewer_class(),
+                           response_cache.generations(namespaces))
+            entry = response_cache.get(key)
+            if entry is None:
+                response = current_app.make_response(f(*args, **kwargs))
+                if response.status_code == 200 and not response.is_streamed:
+                    response_cache.set(key, (
+                        response.get_data(), response.mimetype,
+                        g.get('etag'), g.get('last_modified')))
+                return response
+            body, mimetype, etag, last_modified = entry
+            response = current_app.response_class(body, mimetype=mimetype)
+            if etag:
+                response.set_etag(etag)
+                response.last_modified = last_modified
+            return response.make_conditional(request)
+        return decorated_function
+    return decorator
+
+
+def cached_dict(resource, **options):
+    parts = resource.etag_parts(options.get('fields'), options.get('photo'))
+    if not response_cache.enabled or parts is None:
+        return resource.to_dict(**options)
+    if options.get('embed'):
+        parts = parts, resource.embed_parts(options['embed'])
+    key = make_key('to_dict', resource.__tablename__, parts,
+                   sorted(options.items()), request.script_root)
+    data = response_cache.get(key)
+    if data is None:
+        data = resource.to_dict(**options)
+        response_cache.set(key, data)
+    return data
@@ -0,0 +1,201 @@
+import csv
+import io
+import json
+import math
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from time import perf_counter
+from types import SimpleNamespace
+from flask import current_app
+from PIL import Image
+from app import create_app, db
+from app.models import Item, Category
+from app.utils import store_photo
+
+
+ADJECTIVES = ['red', 'green', 'blue', 'golden', 'small', 'large', 'organic',
+              'vintage', 'classic', 'smoked', 'wild', 'fresh', 'dried',
+              'spicy', 'sweet', 'crispy', 'wooden', 'ceramic', 'linen', 'steel']
+NOUNS = ['apple', 'banana', 'cherry', 'flour', 'honey', 'coffee', 'tea',
+         'cheese', 'bread', 'olive', 'pepper', 'basket', 'mug', 'bowl',
+         'knife', 'towel', 'jar', 'candle', 'lamp', 'chair']
+
+
+def read_rows(text, csv_format, part=0, parts=1):
+    # Parallel loads give each worker every parts-th record, skipped before
+    # it is parsed. CSV records still pass through the tokenizer because
+    # quoted fields may span lines, but only the worker's own become dicts.
+    if csv_format:
+        reader = csv.reader(text)
+        fieldnames = next(reader, None)
+        for number, values in enumerate(reader):
+            if values and number % parts == part:
+                yield reader.line_num, dict(zip(fieldnames, values))
+        return
+    for number, line in enumerate(text, 1):
+        if number % parts == part and line.strip():
+            try:
+                yield number, json.loads(line)
+            except ValueError:
+                yield number, None
+
+
+def import_row(row, category_ids):
+    if not isinstance(row, dict):
+        raise ValueError('row must be a JSON object')
+    if any(row.get(field) in (None, '')
+           for field in ('title', 'price', 'category_id')):
+        raise ValueError('must include title, price and category_id fields')
+    mapping = {'title': str(row['title']),
+               'description': str(row['description'])
+               if row.get('description') not in (None, '') else None,
+               'price': float(row['price']),
+               'category_id': int(row['category_id'])}
+    if len(mapping['title']) > 128 or len(mapping['description'] or '') > 512:
+        raise ValueError('title or description is too long')
+    if not math.isfinite(mapping['price']):
+        raise ValueError('price must be a finite number')
+    if mapping['category_id'] not in category_ids:
+        raise ValueError('unknown category_id {}'.format(mapping['category_id']))
+    return mapping
+
+
+def import_rows(rows, batch_size, photo_dir=None, max_errors=100):
+    category_ids = {id for id, in db.session.query(Category.id)}
+    created, errors, error_count, batch = 0, [], 0, []
+    for line, row in rows:
+        try:
+            mapping = import_row(row, category_ids)
+            if photo_dir and row.get('photo'):
+                with open(os.path.join(photo_dir, row['photo']), 'rb') as f:
+                    mapping['photo_id'] = store_photo(f, row['photo'])
+            batch.append(mapping)
+        except (TypeError, ValueError, OSError) as e:
+            error_count += 1
+            if len(errors) < max_errors:
+                errors.append({'line': line, 'message': str(e)})
+        if len(batch) >= batch_size:
+            Item.bulk_insert(batch)
+            db.session.commit()
+            created += len(batch)
+            batch = []
+    if batch:
+        Item.bulk_insert(batch)
+        db.session.commit()
+        created += len(batch)
+    return created, error_count, errors
+
+
+def worker_app(config):
+    # Pool processes make thumbnails themselves instead of nesting pools.
+    return create_app(SimpleNamespace(**dict(config, THUMBNAIL_WORKERS=0)))
+
+
+def load_file(path, csv_format, batch_size, photo_dir=None, part=0, parts=1):
+    with open(path, encoding='utf-8', newline='') as text:
+        return import_rows(read_rows(text, csv_format, part, parts),
+                           batch_size, photo_dir)
+
+
+def load_part(config, path, csv_format, batch_size, photo_dir, parts, part):
+    with worker_app(config).app_context():
+        return load_file(path, csv_format, batch_size, photo_dir, part, parts)
+
+
+def load_catalog(path, csv_format, workers=1, batch_size=None, photo_dir=None):
+    batch_size = batch_size or current_app.config['ITEM_IMPORT_BATCH_SIZE']
+    start = perf_counter()
+    if workers > 1:
+        fill = partial(load_part, dict(current_app.config), path, csv_format,
+                       batch_size, photo_dir, workers)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(fill, range(workers)))
+    else:
+        results = [load_file(path, csv_format, batch_size, photo_dir)]
+    errors = sorted((error for result in results for error in result[2]),
+                    key=lambda error: error['line'])
+    return (sum(result[0] for result in results),
+            sum(result[1] for result in results), errors,
+            perf_counter() - start)
+
+
+def synthetic_photo(rng, width=800, height=600):
+    img = Image.merge('RGB', [
+        Image.linear_gradient('L').rotate(rng.randrange(360)).resize((width, height)),
+        Image.effect_noise((width, height), rng.randint(16, 96)),
+        Image.radial_gradient('L').resize((width, height))])
+    buffer = io.BytesIO()
+    img.save(buffer, format='JPEG', quality=85)
+    buffer.seek(0)
+    return buffer
+
+
+def seed_photos(numbers, seed):
+    return [store_photo(synthetic_photo(random.Random('{}:photo:{}'.format(
+        seed, number))), 'seed{}.jpg'.format(number)) for number in numbers]
+
+
+def seed_items(numbers, category_ids, photo_ids, seed, batch_size):
+    rng = random.Random('{}:items:{}'.format(seed, numbers.start))
+    created = 0
+    for offset in range(0, len(numbers), batch_size):
+        batch = [{'title': '{} {} {}'.format(rng.choice(ADJECTIVES),
+                                             rng.choice(NOUNS), number),
+                  'description': ' '.join(rng.sample(ADJECTIVES + NOUNS, 8)),
+                  'price': round(rng.uniform(1, 500), 2),
+                  'category_id': category_ids[number % len(category_ids)],
+                  'photo_id': photo_ids[number % len(photo_ids)]
+                  if photo_ids else None}
+                 for number in numbers[offset:offset + batch_size]]
+        Item.bulk_insert(batch)
+        db.session.commit()
+        created += len(batch)
+    return created
+
+
+def seed_part(config, task, *args):
+    with worker_app(config).app_context():
+        return task(*args)
+
+
+def split(numbers, parts):
+    size = max(1, math.ceil(len(numbers) / parts))
+    return [numbers[i:i + size] for i in range(0, len(numbers), size)]
+
+
+def seed_catalog(items, categories, photos=0, workers=1, batch_size=None,
+                 seed=0):
+    batch_size = batch_size or current_app.config['ITEM_IMPORT_BATCH_SIZE']
+    start = perf_counter()
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+
+    def run(task, slices, *args):
+        if executor is None:
+            return [task(numbers, *args) for numbers in slices]
+        return list(executor.map(
+            partial(seed_part, dict(current_app.config), task), slices,
+            *[[arg] * len(slices) for arg in args]))
+
+    try:
+        photo_ids = [photo_id for result in run(
+            seed_photos, split(range(photos), workers * 4), seed)
+            for photo_id in result]
+        rng = random.Random('{}:categories'.format(seed))
+        new_categories = [
+            Category(name='{} {}'.format(rng.choice(ADJECTIVES).title(),
+                                         NOUNS[number % len(NOUNS)].title())[:64],
+                     description='Seeded category {}'.format(number),
+                     photo_id=photo_ids[number % len(photo_ids)]
+                     if photo_ids else None)
+            for number in range(categories)]
+        db.session.add_all(new_categories)
+        db.session.commit()
+        category_ids = [category.id for category in new_categories]
+        created = sum(run(seed_items, split(range(items), workers * 4),
+                          category_ids, photo_ids, seed, batch_size))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return created, len(category_ids), len(photo_ids), perf_counter() - start
@@ -0,0 +1,145 @@
+import os
+import time
+import click
+from app import db
+from app.catalog import load_catalog, seed_catalog
+from app.models import Item, Category, SearchableMixin, SearchOutbox
+from app.storage import FileSystemStorage
+from app.utils import CONTENT_ADDRESSED_PHOTO_ID, store_photo, delete_photo
+from config import imagedir
+
+
+def register(app):
+    @app.cli.group()
+    def photos():
+        """Photo storage commands."""
+        pass
+
+    @photos.command()
+    @click.option('--source', default=imagedir,
+                  type=click.Path(exists=True, file_okay=False),
+                  help='Directory holding the legacy photo files.')
+    def migrate(source):
+        """Move legacy photos into the content-addressed store."""
+        legacy = FileSystemStorage(source)
+        migrated = {}
+        for model in (Item, Category):
+            for obj in model.query.filter(model.photo_id.isnot(None)):
+                if CONTENT_ADDRESSED_PHOTO_ID.match(obj.photo_id):
+                    continue
+                if obj.photo_id not in migrated:
+                    if not legacy.exists(obj.photo_id):
+                        click.echo('Missing photo file: {}'.format(obj.photo_id))
+                        continue
+                    with legacy.open(obj.photo_id) as f:
+                        migrated[obj.photo_id] = store_photo(f, obj.photo_id)
+                obj.photo_id = migrated[obj.photo_id]
+        db.session.commit()
+        for legacy_photo_id in migrated:
+            delete_photo(legacy_photo_id, legacy)
+        click.echo('Migrated {} photos.'.format(len(migrated)))
+
+    @app.cli.group()
+    def search():
+        """Search index commands."""
+        pass
+
+    @search.command()
+    @click.option('--workers', type=int, default=4,
+                  help='Processes filling the new index in parallel.')
+    @click.option('--chunk-size', type=int,
+                  help='Documents per bulk request and per database fetch.')
+    @click.option('--keep-old', is_flag=True,
+                  help='Keep the previous index after the alias is switched.')
+    def reindex(workers, chunk_size, keep_old):
+        """Rebuild the search index from the database."""
+        if not app.search_backend:
+            raise click.ClickException('No search backend is configured.')
+        for model in SearchableMixin.searchable_models().values():
+            try:
+                indexed, index, elapsed = model.reindex(workers, chunk_size,
+                                                        keep_old)
+            except RuntimeError as e:
+                raise click.ClickException(str(e))
+            click.echo('Indexed {} {} documents into {} in {:.1f}s '
+                       '({:.0f} docs/s).'.format(
+                           indexed, model.__tablename__, index, elapsed,
+                           indexed / elapsed if elapsed else 0))
+
+    @search.command()
+    @click.option('--interval', type=float, default=1.0,
+                  help='Seconds to sleep when the outbox is empty.')
+    @click.option('--batch-size', type=int,
+                  help='Outbox entries per bulk request.')
+    def worker(interval, batch_size):
+        """Drain the search outbox until interrupted."""
+        if not app.elasticsearch:
+            raise click.ClickException('ELASTICSEARCH_URL is not configured.')
+        if not app.config['REDIS_URL']:
+            app.logger.warning('REDIS_URL is not configured: web processes will '
+                               'serve cached search results for up to %ss '
+                               'after they are indexed.',
+                               app.config['SEARCH_CACHE_TTL'])
+        batch_size = batch_size or app.config['SEARCH_BULK_CHUNK_SIZE']
+        while True:
+            if not SearchOutbox.drain(batch_size):
+                stats = SearchOutbox.stats()
+                if stats['pending']:
+                    app.logger.info('Search outbox: %(pending)d pending, '
+                                    '%(retrying)d retrying, lag %(lag_seconds).1fs',
+                                    stats)
+                time.sleep(interval)
+
+    @search.command()
+    def status():
+        """Show search outbox backlog and lag."""
+        click.echo('{pending} pending, {retrying} retrying, lag {lag_seconds:.1f}s'
+                   .format(**SearchOutbox.stats()))
+
+    @app.cli.group()
+    def catalog():
+        """Catalog loading and seeding commands."""
+        pass
+
+    @catalog.command()
+    @click.argument('path', type=click.Path(exists=True, dir_okay=False))
+    @click.option('--format', 'file_format', type=click.Choice(['ndjson', 'csv']),
+                  help='File format; guessed from the extension by default.')
+    @click.option('--workers', type=int, default=4,
+                  help='Processes inserting rows in parallel.')
+    @click.option('--batch-size', type=int,
+                  help='Rows per bulk insert and commit.')
+    @click.option('--photo-dir', type=click.Path(exists=True, file_okay=False),
+                  help='Directory that "photo" columns are relative to.')
+    def load(path, file_format, workers, batch_size, photo_dir):
+        """Import items from an NDJSON or CSV file."""
+        csv_format = (file_format or os.path.splitext(path)[1].lstrip('.')
+                      .lower()) == 'csv'
+        created, error_count, errors, elapsed = load_catalog(
+            path, csv_format, workers, batch_size, photo_dir)
+        for error in errors[:20]:
+            click.echo('Line {line}: {message}'.format(**error), err=True)
+        click.echo('Loaded {} items in {:.1f}s ({:.0f} rows/s), {} rows '
+                   'rejected.'.format(created, elapsed,
+                                      created / elapsed if elapsed else 0,
+                                      error_count))
+
+    @catalog.command()
+    @click.option('--items', type=click.IntRange(0), default=10000)
+    @click.option('--categories', type=click.IntRange(1), default=20)
+    @click.option('--photos', type=click.IntRange(0), default=0,
+                  help='Distinct synthetic photos shared by the items.')
+    @click.option('--workers', type=int, default=4,
+                  help='Processes generating photos and rows in parallel.')
+    @click.option('--batch-size', type=int,
+                  help='Rows per bulk insert and commit.')
+    @click.option('--seed', type=int, default=0,
+                  help='Random seed, so fixtures are reproducible.')
+    def seed(items, categories, photos, workers, batch_size, seed):
+        """Generate a synthetic catalog for development and benchmarks."""
+        created, categories, photos, elapsed = seed_catalog(
+            items, categories, photos, workers, batch_size, seed)
+        click.echo('Seeded {} items in {} categories with {} photos in {:.1f}s '
+                   '({:.0f} rows/s).'.format(created, categories, photos,
+                                             elapsed,
+                                             created / elapsed if elapsed else 0))
@@ -0,0 +1,54 @@
+import hashlib
+from flask import current_app, g, request, session
+from flask_login import current_user
+from werkzeug.exceptions import abort
+
+
+def make_etag(*parts):
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+def collection_etag(resources, *extra, fields=None, photo=None):
+    parts = [resource.etag_parts(fields, photo) for resource in resources]
+    if any(part is None for part in parts):
+        return None
+    return make_etag(parts, *extra)
+
+
+def viewer_class():
+    if current_user.is_anonymous:
+        return 'anonymous'
+    return current_user.permission
+
+
+def validate(etag, last_modified=None):
+    if etag is None:
+        return
+    if request.blueprint != 'api' and session.get('_flashes'):
+        return
+    g.etag = etag
+    g.last_modified = last_modified
+    if request.if_none_match:
+        fresh = request.if_none_match.contains(etag)
+    elif last_modified and request.if_modified_since:
+        fresh = last_modified.replace(microsecond=0) <= request.if_modified_since
+    else:
+        fresh = False
+    if fresh:
+        abort(current_app.response_class(status=304))
+
+
+def add_cache_headers(response):
+    if request.method not in ('GET', 'HEAD') or \
+            response.status_code not in (200, 304):
+        return response
+    if 'etag' in g and not response.get_etag()[0]:
+        response.set_etag(g.etag)
+        if g.last_modified:
+            response.last_modified = g.last_modified
+    policy = current_app.config['CACHE_CONTROL'].get(request.endpoint)
+    if policy:
+        if request.blueprint != 'api' and current_user.is_authenticated:
+            policy = policy.replace('public', 'private')
+        response.headers['Cache-Control'] = policy
+    return response
@@ -1,10 +1,13 @@
 from app.main.forms import EditItemForm, EditCategoryForm, EditUserRightsForm, SearchForm
 from flask import render_template, flash, redirect, url_for, request, session, current_app, g
 from flask_login import current_user, login_required
-from app.models import User, Item, Category
+from app.models import User, Item, Category, release_photo
 from app import db
 from app.main import bp
-from app.utils import upload_photo, delete_photo, permission_required
+from app.utils import upload_photo, permission_required
+from app.http_cache import make_etag, collection_etag, validate, viewer_class
+from app.cache import cached
+from app.search import search_filters
 
 
 @bp.before_app_request
@@ -56,7 +59,7 @@ def edit_item(item_id):
         item.price = form.price.data
         item.category_id = form.categories.data
         if item.photo_id:
-            delete_photo(item.photo_id)
+            release_photo(item.photo_id)
             item.photo_id = None
         if form.image.data:
             item.photo_id = upload_photo(form.image.data)
@@ -79,7 +82,7 @@ def delete_item(item_id):
     item = Item.query.filter_by(id=item_id).first_or_404()
     category_id = item.category_id
     if item.photo_id:
-        delete_photo(item.photo_id)
+        release_photo(item.photo_id)
     db.session.delete(item)
     db.session.commit()
     flash('Item have been deleted.')
@@ -87,8 +90,10 @@ def delete_item(item_id):
 
 
 @bp.route('/item/<item_id>', methods=['GET'])
+@cached('item')
 def show_item(item_id):
     item = Item.query.filter_by(id=item_id).first_or_404()
+    validate(make_etag(item.etag_parts(), viewer_class()), item.updated_at)
     return render_template('show_item.html', item=item)
 
 
@@ -131,7 +136,7 @@ def edit_category(category_id):
         category.name = form.name.data
         category.description = form.description.data
         if category.photo_id:
-            delete_photo(category.photo_id)
+            release_photo(category.photo_id)
             category.photo_id = None
         if form.image.data:
             category.photo_id = upload_photo(form.image.data)
@@ -152,7 +157,7 @@ def edit_category(category_id):
 def delete_category(category_id):
     category = Category.query.filter_by(id=category_id).first_or_404()
     if category.photo_id:
-        delete_photo(category.photo_id)
+        release_photo(category.photo_id)
     db.session.delete(category)
     db.session.commit()
     flash('Category have been deleted.')
@@ -160,6 +165,7 @@ def delete_category(category_id):
 
 
 @bp.route('/category/<category_id>', methods=['GET', 'POST'])
+@cached('category', 'item')
 def show_category(category_id):
     category = Category.query.filter_by(id=category_id).first_or_404()
     page = request.args.get('page', 1, type=int)
@@ -169,22 +175,30 @@ def show_category(category_id):
         if items.has_next else None
     prev_url = url_for('main.show_category', category_id=category_id, page=items.prev_num) \
         if items.has_prev else None
+    validate(collection_etag(items.items, category.etag_parts(), items.total,
+                             viewer_class()))
     return render_template('show_category.html', category=category,
                            items=items.items, next_url=next_url, prev_url=prev_url)
 
 
 @bp.route('/catalog', methods=['GET'])
 def show_categories():
-    if 'editing_categories' in session:
-        del session['editing_categories']
+    if session.get('editing_categories') != url_for('main.show_categories'):
+        session['editing_categories'] = url_for('main.show_categories')
+    return render_categories()
+
+
+@cached('category')
+def render_categories():
     page = request.args.get('page', 1, type=int)
     categories = Category.query.paginate(
         page, current_app.config['ITEMS_PER_PAGE'], True)
-    next_url = url_for('show_categories', page=categories.next_num) \
+    next_url = url_for('main.show_categories', page=categories.next_num) \
         if categories.has_next else None
-    prev_url = url_for('show_categories', page=categories.prev_num) \
+    prev_url = url_for('main.show_categories', page=categories.prev_num) \
         if categories.has_prev else None
-    session['editing_categories'] = url_for('main.show_categories')
+    Category.prepare_collection(categories.items)
+    validate(collection_etag(categories.items, categories.total, viewer_class()))
     return render_template('show_categories.html', categories=categories.items,
                            next_url=next_url, prev_url=prev_url)
 
@@ -222,25 +236,25 @@ def manage_user_rights(user_id):
                            form=form, user=user)
 
 
-@bp.route('/delete_category_photos/<photo_id>', methods=['GET', 'POST'])
+@bp.route('/delete_category_photos/<path:photo_id>', methods=['GET', 'POST'])
 @login_required
 @permission_required('manager')
 def delete_category_photos(photo_id):
-    delete_photo(photo_id)
+    category = Category.query.filter_by(photo_id=photo_id).first_or_404()
+    release_photo(photo_id)
     flash('Photo have been deleted.')
-    category = Category.query.filter_by(photo_id=photo_id).first()
     category.photo_id = None
     db.session.commit()
     return redirect(session['editing_category'])
 
 
-@bp.route('/delete_item_photos/<photo_id>', methods=['GET', 'POST'])
+@bp.route('/delete_item_photos/<path:photo_id>', methods=['GET', 'POST'])
 @login_required
 @permission_required('manager')
 def delete_item_photos(photo_id):
-    delete_photo(photo_id)
+    item = Item.query.filter_by(photo_id=photo_id).first_or_404()
+    release_photo(photo_id)
     flash('Photo have been deleted.')
-    item = Item.query.filter_by(photo_id=photo_id).first()
     item.photo_id = None
     db.session.commit()
     return redirect(session['editing_item'])
@@ -251,11 +265,20 @@ def search():
     if not g.search_form.validate():
         return redirect(url_for('main.index'))
     page = request.args.get('page', 1, type=int)
-    items, total = Item.search(g.search_form.q.data, page,
-                               current_app.config['ITEMS_PER_PAGE'])
-    next_url = url_for('main.search', q=g.search_form.q.data, page=page + 1) \
-        if total > page * current_app.config['ITEMS_PER_PAGE'] else None
-    prev_url = url_for('main.search', q=g.search_form.q.data, page=page - 1) \
+    results = Item.search(g.search_form.q.data, page,
+                          current_app.config['ITEMS_PER_PAGE'],
+                          search_filters(Item, request.args))
+    args = request.args.to_dict(flat=False)
+    args.pop('page', None)
+    next_url = url_for('main.search', page=page + 1, **args) \
+        if results['total'] > page * current_app.config['ITEMS_PER_PAGE'] else None
+    prev_url = url_for('main.search', page=page - 1, **args) \
         if page > 1 else None
-    return render_template('search.html', title='Search', items=items,
-                           next_url=next_url, prev_url=prev_url)
\ No newline at end of file
+    facets = results['facets']
+    category_names = dict(db.session.query(Category.id, Category.name).filter(
+        Category.id.in_([bucket['value'] for bucket in facets['category_id']]))) \
+        if facets.get('category_id') else {}
+    return render_template('search.html', title='Search', items=results['hits'],
+                           total=results['total'], facets=facets, args=args,
+                           category_names=category_names,
+                           next_url=next_url, prev_url=prev_url)
@@ -1,65 +1,313 @@
-import jwt, base64, os
+import jwt, base64, json, os
 from flask import current_app, url_for
 from time import time
 from app import db, login
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
-from app.search import add_to_index, remove_from_index, query_index
+from sqlalchemy.dialects import mysql
+from sqlalchemy.orm import make_transient_to_detached
+from app.search import reindex, query_index, suggest_index, search_indexer, \
+    prefix_index
 from datetime import datetime, timedelta
-from app.utils import upload_photo
+from app.utils import upload_photo, delete_photo, photo_fields, thumbnail_ready
+from app.http_cache import collection_etag, validate
+from app.cache import response_cache, cached_dict, identity_cache
+from app.serializers import fast_url_for
 
 
 class SearchableMixin(object):
     @classmethod
-    def search(cls, expression, page, per_page):
-        ids, total = query_index(cls.__tablename__, expression, page, per_page)
-        if total == 0:
-            return cls.query.filter_by(id=0), 0
-        when = []
-        for i in range(len(ids)):
-            when.append((ids[i], i))
-        return cls.query.filter(cls.id.in_(ids)).order_by(
-            db.case(when, value=cls.id)), total
-
-    @classmethod
-    def before_commit(cls, session):
-        session._changes = {
-            'add': list(session.new),
-            'update': list(session.dirty),
-            'delete': list(session.deleted)
-        }
+    def search(cls, expression, page, per_page, filters=None):
+        return query_index(cls, expression, page, per_page, filters)
 
     @classmethod
-    def after_commit(cls, session):
-        if not current_app.elasticsearch: # or any other search engine, which you'll use
+    def suggest(cls, expression, limit=8):
+        return suggest_index(cls, expression, limit)
+
+    @classmethod
+    def after_flush(cls, session, flush_context):
+        # Collected per flush rather than at commit: changes flushed earlier
+        # in the transaction are no longer in new/dirty/deleted by then.
+        changed_tables = session.info.setdefault('changed_tables', set())
+        changed_ids = session.info.setdefault('changed_ids', {})
+        for changes in (session.new, session.dirty, session.deleted):
+            for obj in changes:
+                changed_tables.add(obj.__tablename__)
+                if isinstance(obj, SearchableMixin):
+                    changed_ids.setdefault(obj.__tablename__, set()).add(obj.id)
+        backend = current_app.search_backend
+        if not backend:
             return
-        for obj in session._changes['add']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['update']:
+        if backend.deferred:
+            SearchOutbox.enqueue(session, [
+                (obj.__tablename__, obj.id)
+                for changes in (session.new, session.dirty, session.deleted)
+                for obj in changes if isinstance(obj, SearchableMixin)])
+            return
+        changes = {}
+        for obj in list(session.new) + list(session.dirty):
             if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['delete']:
+                changes.setdefault(obj.__tablename__, ([], []))[0].append(obj)
+        for obj in session.deleted:
             if isinstance(obj, SearchableMixin):
-                remove_from_index(obj.__tablename__, obj)
-        session._changes = None
+                changes.setdefault(obj.__tablename__, ([], []))[1].append(obj.id)
+        for index, (models, removed_ids) in changes.items():
+            backend.update(index, models, removed_ids)
+
+    @classmethod
+    def after_commit(cls, session):
+        response_cache.invalidate(*session.info.pop('changed_tables', set()))
+        for tablename, ids in session.info.pop('changed_ids', {}).items():
+            prefix_index.changed(tablename, ids)
+        if session.info.pop('search_outbox', False):
+            search_indexer.wake()
+
+    @classmethod
+    def bulk_changed(cls, ids=(), removed_ids=(), models=None):
+        # Bulk statements bypass the flush events, so sync search and the
+        # response cache for them here.
+        invalidate_on_commit(cls.__tablename__)
+        db.session.info.setdefault('changed_ids', {}).setdefault(
+            cls.__tablename__, set()).update(list(ids) + list(removed_ids))
+        backend = current_app.search_backend
+        if not backend:
+            return
+        if backend.deferred:
+            SearchOutbox.enqueue(db.session, [
+                (cls.__tablename__, id) for id in list(ids) + list(removed_ids)])
+            return
+        if models is None:
+            models = cls.search_query().filter(cls.id.in_(ids)).all() \
+                if ids else []
+        backend.update(cls.__tablename__, models, removed_ids)
+
+    @classmethod
+    def bulk_insert(cls, mappings):
+        if not mappings:
+            return
+        # return_defaults would make the ORM insert row by row to collect ids,
+        # so send one statement for the batch wherever the backend can tell
+        # which ids it took.
+        table = cls.__table__
+        keys = set().union(*mappings)
+        rows = [{key: mapping.get(key) for key in keys} for mapping in mappings]
+        dialect = db.session.connection().dialect
+        if dialect.implicit_returning:
+            # A multi-row INSERT ... RETURNING yields ids in VALUES order.
+            ids = [id for id, in db.session.execute(
+                table.insert().values(rows).returning(table.c.id))]
+        elif dialect.name == 'sqlite':
+            db.session.execute(table.insert(), rows)
+            # SQLite has a single writer: the transaction holds the write lock
+            # from its first insert, so the batch took the highest ids.
+            ids = [id for id, in db.session.execute(
+                db.select([table.c.id]).order_by(table.c.id.desc())
+                .limit(len(rows)))][::-1]
+        elif dialect.name == 'mysql':
+            # InnoDB hands one multi-row INSERT a single block of ids, even
+            # with concurrent writers; lastrowid is the first of them.
+            first = db.session.execute(table.insert().values(rows)).lastrowid
+            step = db.session.execute(
+                'SELECT @@session.auto_increment_increment').scalar()
+            ids = range(first, first + len(rows) * step, step)
+        else:
+            ids = [db.session.execute(table.insert(), row)
+                   .inserted_primary_key[0] for row in rows]
+        for mapping, id in zip(mappings, ids):
+            mapping['id'] = id
+        cls.bulk_changed([mapping['id'] for mapping in mappings],
+                         models=[cls(**mapping) for mapping in mappings])
+
+    @classmethod
+    def search_query(cls):
+        return cls.query.options(
+            db.load_only(*cls.__search_mapping__['properties'])).order_by(cls.id)
 
     @classmethod
-    def reindex(cls):
-        for obj in cls.query:
-            add_to_index(cls.__tablename__, obj)
+    def reindex_range(cls, index, id_range, chunk_size=None):
+        return reindex(index, cls.search_query().filter(cls.id.between(*id_range)),
+                       chunk_size)
+
+    @classmethod
+    def reindex(cls, workers=1, chunk_size=None, keep_old=False):
+        result = current_app.search_backend.rebuild(cls, workers, chunk_size,
+                                                    keep_old)
+        response_cache.invalidate('search:' + cls.__tablename__)
+        return result
+
+    @staticmethod
+    def searchable_models():
+        return {model.__tablename__: model
+                for model in SearchableMixin.__subclasses__()}
+
+
+def invalidate_on_commit(*tables):
+    db.session.info.setdefault('changed_tables', set()).update(tables)
 
 
-db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
+db.event.listen(db.session, 'after_flush', SearchableMixin.after_flush)
 db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
 
 
+class SearchOutbox(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    index = db.Column(db.String(64), nullable=False)
+    object_id = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    available_at = db.Column(db.DateTime, index=True, nullable=False,
+                             default=datetime.utcnow)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.Text)
+
+    @staticmethod
+    def enqueue(session, changes):
+        now = datetime.utcnow()
+        rows = [{'index': index, 'object_id': object_id, 'created_at': now,
+                 'available_at': now, 'attempts': 0}
+                for index, object_id in changes]
+        if rows:
+            session.connection().execute(SearchOutbox.__table__.insert(), rows)
+            session.info['search_outbox'] = True
+
+    @classmethod
+    def drain(cls, batch_size=500):
+        now = datetime.utcnow()
+        entries = cls.query.filter(cls.available_at <= now).order_by(cls.id) \
+            .limit(batch_size).with_for_update(skip_locked=True).all()
+        if not entries:
+            db.session.rollback()
+            return 0
+        # Repeated updates to the same object collapse into one action that
+        # reflects the row as it is now; a row that no longer exists is removed.
+        pending = {}
+        for entry in entries:
+            pending.setdefault(entry.index, set()).add(entry.object_id)
+        failed = {}
+        models = SearchableMixin.searchable_models()
+        for index, ids in pending.items():
+            model = models[index]
+            found = model.search_query().filter(model.id.in_(ids)).all()
+            errors = current_app.search_backend.update(
+                index, found, ids - {obj.id for obj in found})
+            failed.update(((index, id), error) for id, error in errors.items())
+        backoff = current_app.config['SEARCH_OUTBOX_BACKOFF']
+        for entry in entries:
+            error = failed.get((entry.index, str(entry.object_id)))
+            if error is None:
+                db.session.delete(entry)
+                continue
+            entry.attempts += 1
+            entry.last_error = str(error)
+            entry.available_at = now + timedelta(seconds=min(
+                backoff * 2 ** (entry.attempts - 1),
+                current_app.config['SEARCH_OUTBOX_MAX_BACKOFF']))
+        db.session.commit()
+        response_cache.invalidate(*('search:' + index for index in pending))
+        return len(entries)
+
+    @classmethod
+    def stats(cls):
+        pending, retrying, oldest = db.session.query(
+            db.func.count(cls.id),
+            db.func.count(db.case([(cls.attempts > 0, cls.id)])),
+            db.func.min(cls.created_at)).one()
+        return {'pending': pending, 'retrying': retrying,
+                'lag_seconds': (datetime.utcnow() - oldest).total_seconds()
+                if oldest else 0.0}
+
+
+def encode_cursor(sort, resource):
+    payload = json.dumps([sort, getattr(resource, sort), resource.id])
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('utf-8').rstrip('=')
+
+
+def decode_cursor(cursor, sort):
+    try:
+        payload = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        cursor_sort, value, last_id = json.loads(payload.decode('utf-8'))
+    except (ValueError, TypeError):
+        raise ValueError('invalid cursor')
+    if cursor_sort != sort or not isinstance(last_id, int):
+        raise ValueError('cursor does not match sort order')
+    return value, last_id
+
+
 class PaginatedAPIMixin(object):
+    __sortable__ = ['id']
+    __fields__ = []
+    __field_columns__ = {}
+    __etag_columns__ = ['id']
+    __embeddable__ = []
+
+    @classmethod
+    def prepare_collection(cls, resources, fields=None):
+        pass
+
+    def etag_parts(self, fields=None, photo=None):
+        return None
+
+    @classmethod
+    def wants(cls, field, fields=None, photo=None):
+        # Parts of the ETag that cost a query or a storage round-trip are only
+        # computed when the response includes the field they describe.
+        if field == 'photo' and photo == 'none':
+            return False
+        return field in (fields or cls.__fields__)
+
+    def embed_parts(self, embed):
+        return tuple((name, getattr(self, name).id, getattr(self, name).version)
+                     for name in embed)
+
+    @classmethod
+    def parse_fields(cls, args):
+        fields = sorted(set(args['fields'].split(','))) \
+            if args.get('fields') else None
+        embed = sorted(set(args['embed'].split(','))) if args.get('embed') else []
+        for name, requested, allowed in (('fields', fields or [], cls.__fields__),
+                                         ('embed', embed, cls.__embeddable__)):
+            unknown = [value for value in requested if value not in allowed]
+            if unknown:
+                raise ValueError('unknown {} {}; use: {}'.format(
+                    name, ', '.join(unknown), ', '.join(allowed)))
+        return fields and tuple(fields), tuple(embed)
+
+    @classmethod
+    def field_options(cls, fields, embed):
+        # Sparse fieldsets load only the columns they serialize, plus the ones
+        # the ETag is built from.
+        options = [db.selectinload(getattr(cls, name)) for name in embed]
+        if fields:
+            columns = set(cls.__etag_columns__ + cls.__sortable__)
+            for field in list(fields) + list(embed):
+                columns.update(cls.__field_columns__.get(field, [field]))
+            options.append(db.load_only(*columns))
+        return options
+
     @staticmethod
-    def to_collection_dict(query, page, per_page, endpoint, **kwargs):
+    def serialize_options(photo, fields, embed, kwargs):
+        options = {'photo': photo} if photo else {}
+        kwargs['photo'] = photo
+        if fields:
+            options['fields'] = fields
+            kwargs['fields'] = ','.join(fields)
+        if embed:
+            options['embed'] = embed
+            kwargs['embed'] = ','.join(embed)
+        return options
+
+    @classmethod
+    def to_collection_dict(cls, query, page, per_page, endpoint, photo=None,
+                           fields=None, embed=(), **kwargs):
         resources = query.paginate(page, per_page, False)
+        cls.prepare_collection(resources.items, fields)
+        validate(collection_etag(resources.items, resources.total, photo, fields,
+                                 [item.embed_parts(embed)
+                                  for item in resources.items],
+                                 fields=fields, photo=photo))
+        options = cls.serialize_options(photo, fields, embed, kwargs)
         data = {
-            'items': [item.to_dict(to_collection=True) for item in resources.items],
+            'items': [cached_dict(item, to_collection=True, **options)
+                      for item in resources.items],
             '_meta': {
                 'page': page,
                 'per_page': per_page,
@@ -77,6 +325,70 @@ class PaginatedAPIMixin(object):
         }
         return data
 
+    @classmethod
+    def to_cursor_collection_dict(cls, query, after, per_page, endpoint,
+                                  sort='id', with_total=False, photo=None,
+                                  fields=None, embed=(), **kwargs):
+        # Keyset pagination: seeks past the last (sort, id) pair instead of
+        # using OFFSET, so every page costs the same no matter how deep it is.
+        if sort not in cls.__sortable__:
+            raise ValueError('cannot sort by {}'.format(sort))
+        column = getattr(cls, sort)
+        total = query.order_by(None).count() if with_total else None
+        if after:
+            value, last_id = decode_cursor(after, sort)
+        if column is cls.id:
+            if after:
+                query = query.filter(cls.id > last_id)
+            resources = query.order_by(cls.id).limit(per_page + 1).all()
+        else:
+            # NULLs are walked as a second phase so both stay index range
+            # scans: first (column, id) over the non-NULL values, then the
+            # NULL block by id. A cursor with a null value is in that phase.
+            resources = []
+            if not after or value is not None:
+                # The redundant lower bound lets the planner start the range
+                # at the cursor instead of filtering from the first entry.
+                seek = db.and_(column >= value, db.or_(
+                    column > value, cls.id > last_id)) if after else \
+                    column.isnot(None)
+                resources = query.filter(seek).order_by(column, cls.id) \
+                    .limit(per_page + 1).all()
+            if len(resources) <= per_page:
+                nulls = query.filter(column.is_(None))
+                if after and value is None:
+                    nulls = nulls.filter(cls.id > last_id)
+                resources += nulls.order_by(cls.id) \
+                    .limit(per_page + 1 - len(resources)).all()
+        next_cursor = encode_cursor(sort, resources[per_page - 1]) \
+            if len(resources) > per_page else None
+        resources = resources[:per_page]
+        cls.prepare_collection(resources, fields)
+        validate(collection_etag(resources, next_cursor, total, photo, fields,
+                                 [item.embed_parts(embed)
+                                  for item in resources],
+                                 fields=fields, photo=photo))
+        if with_total:
+            kwargs['total'] = 1
+        options = cls.serialize_options(photo, fields, embed, kwargs)
+        data = {
+            'items': [cached_dict(item, to_collection=True, **options)
+                      for item in resources],
+            '_meta': {
+                'per_page': per_page,
+                'sort': sort
+            },
+            '_links': {
+                'self': url_for(endpoint, after=after, per_page=per_page,
+                                sort=sort, **kwargs),
+                'next': url_for(endpoint, after=next_cursor, per_page=per_page,
+                                sort=sort, **kwargs) if next_cursor else None
+            }
+        }
+        if with_total:
+            data['_meta']['total_items'] = total
+        return data
+
 
 class User(PaginatedAPIMixin, UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -86,6 +398,10 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
     permission = db.Column(db.String(32))
     token = db.Column(db.String(32), index=True, unique=True)
     token_expiration = db.Column(db.DateTime)
+    # Signed tokens carry a sub-second iat; MySQL DATETIME would otherwise
+    # drop the fraction and move the cutoff across tokens issued that second.
+    tokens_revoked_at = db.Column(db.DateTime().with_variant(
+        mysql.DATETIME(fsp=6), 'mysql'), index=True)
 
     def __repr__(self):
         return '<User: {} \n Email: {} \n Permission: {}>'.format(
@@ -100,7 +416,7 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
     def get_reset_password_token(self, expires_in=600):
         return jwt.encode(
             {'reset_password': self.id, 'exp': time() + expires_in},
-            current_app.config['SECRET_KEY'], algorithm='HS256').decode('utf-8')
+            current_app.config['SECRET_KEY'], algorithm='HS256')
 
     @staticmethod
     def verify_reset_password_token(token):
@@ -111,14 +427,14 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
             return
         return User.query.get(id)
 
-    def to_dict(self, include_email=False):
+    def to_dict(self, include_email=False, to_collection=False):
         data = {
             'id': self.id,
             'username': self.username,
             'permission': self.permission,
             '_links': {
-                'self': url_for('api.get_user', id=self.id),
-                'get_users': url_for('api.get_users')
+                'self': fast_url_for('api.get_user', id=self.id),
+                'get_users': fast_url_for('api.get_users')
             }
         }
         if include_email:
@@ -132,7 +448,21 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
         if new_user and 'password' in data:
             self.set_password(data['password'])
 
-    def get_token(self, expires_in=3600):
+    @db.validates('permission')
+    def validate_permission(self, key, permission):
+        if db.inspect(self).persistent and permission != self.permission:
+            self.tokens_revoked_at = datetime.utcnow()
+        return permission
+
+    def get_token(self, expires_in=None):
+        expires_in = min(expires_in or current_app.config['API_TOKEN_LIFETIME'],
+                         current_app.config['API_TOKEN_LIFETIME'])
+        if current_app.config['API_TOKEN_MODE'] == 'jwt':
+            return jwt.encode(
+                {'sub': str(self.id), 'name': self.username,
+                 'perm': self.permission, 'iat': time(),
+                 'exp': time() + expires_in},
+                current_app.config['SECRET_KEY'], algorithm='HS256')
         now = datetime.utcnow()
         if self.token and self.token_expiration > now + timedelta(seconds=60):
             return self.token
@@ -143,53 +473,130 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
 
     def revoke_token(self):
         self.token_expiration = datetime.utcnow() - timedelta(seconds=1)
+        self.tokens_revoked_at = datetime.utcnow()
+
+    def identity(self):
+        return {field: getattr(self, field) for field in IDENTITY_FIELDS}
+
+    @staticmethod
+    def from_identity(identity):
+        user = User(**identity)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    @staticmethod
+    def revocation_cutoffs():
+        # Only revocations younger than the longest token lifetime matter.
+        since = datetime.utcnow() - timedelta(
+            seconds=current_app.config['API_TOKEN_LIFETIME'])
+        epoch = datetime(1970, 1, 1)
+        return {user_id: (revoked_at - epoch) // timedelta(microseconds=1)
+                for user_id, revoked_at in db.session.query(
+                    User.id, User.tokens_revoked_at).filter(
+                    User.tokens_revoked_at > since)}
+
+    @staticmethod
+    def check_signed_token(token):
+        try:
+            claims = jwt.decode(token, current_app.config['SECRET_KEY'],
+                                algorithms=['HS256'])
+            user_id = int(claims['sub'])
+        except (jwt.InvalidTokenError, KeyError, ValueError):
+            return None
+        cutoff = identity_cache.revocations(User.revocation_cutoffs).get(user_id)
+        if cutoff is not None and round(claims['iat'] * 1000000) <= cutoff:
+            return None
+        return User.from_identity({'id': user_id, 'username': claims['name'],
+                                   'permission': claims['perm']})
 
     @staticmethod
     def check_token(token):
-        user = User.query.filter_by(token=token).first()
-        if user is None or user.token_expiration < datetime.utcnow():
+        if token.count('.') == 2:
+            return User.check_signed_token(token)
+        key = identity_cache.key('token', token)
+        identity = identity_cache.get(key)
+        if identity is not None:
+            user = User.from_identity(identity)
+        else:
+            generation = identity_cache.generation()
+            user = User.query.filter_by(token=token).first()
+            if user is None:
+                return None
+            identity_cache.set(key, user.identity(), generation)
+        if user.token_expiration < datetime.utcnow():
             return None
         return user
 
 
+IDENTITY_FIELDS = ('id', 'username', 'permission', 'token', 'token_expiration')
+
+
 class Item(PaginatedAPIMixin, SearchableMixin, db.Model):
-    __searchable__ = ['title']
+    __searchable__ = ['title', 'description']
+    __search_mapping__ = {'properties': {
+        'title': {'type': 'text',
+                  'fields': {'suggest': {'type': 'completion'}}},
+        'description': {'type': 'text'},
+        'price': {'type': 'float'},
+        'category_id': {'type': 'integer'},
+        'photo_id': {'type': 'keyword', 'index': False}}}
+    __search_facets__ = {'category_id': {'type': 'terms'},
+                         'price': {'type': 'histogram', 'interval': 50}}
+    __suggest__ = 'title'
+    __sortable__ = ['id', 'price']
+    __fields__ = ['id', 'title', 'description', 'price', 'category_id',
+                  '_links', 'photo']
+    __field_columns__ = {'_links': ['category_id'], 'photo': [],
+                         'category': ['category_id']}
+    __etag_columns__ = ['id', 'version', 'photo_id', 'updated_at']
+    __embeddable__ = ['category']
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(128), index=True)
     description = db.Column(db.String(512))
     price = db.Column(db.Float, index=True)
     category_id = db.Column(db.Integer, db.ForeignKey('category.id'), nullable=False)
     photo_id = db.Column(db.String(128))
+    version = db.Column(db.Integer, nullable=False, server_default='1')
+    updated_at = db.Column(db.DateTime, index=True, default=datetime.utcnow,
+                           onupdate=datetime.utcnow)
+    __mapper_args__ = {'version_id_col': version}
 
     def __repr__(self):
         return '<Id: {} \n Title: {} \n Category id: {} \n Photo id: {}>'.format(
             self.id, self.title, self.category_id, self.photo_id)
 
-    def to_dict(self, to_collection=False):
+    def etag_parts(self, fields=None, photo=None):
+        return self.id, self.version, self.wants('photo', fields, photo) and \
+            thumbnail_ready(self.photo_id)
+
+    def to_dict(self, to_collection=False, photo='inline', fields=None,
+                embed=()):
         thumbnail_size = 500
         if to_collection:
             thumbnail_size = 120
-        data = {
-            'id': self.id,
-            'title': self.title,
-            'description': self.description,
-            'price': self.price,
-            'category_id': self.category_id,
-            'photo_data': self.get_thumbnail(self.photo_id, thumbnail_size, url=False),
-            '_links': {
-                'self': url_for('api.get_item', id=self.id),
-                'category': url_for('api.get_category', id=self.category_id)
+        fields = fields or self.__fields__
+        data = {field: getattr(self, field) for field in
+                ('id', 'title', 'description', 'price', 'category_id')
+                if field in fields}
+        if '_links' in fields:
+            data['_links'] = {
+                'self': fast_url_for('api.get_item', id=self.id),
+                'category': fast_url_for('api.get_category', id=self.category_id)
             }
-        }
+        if 'photo' in fields:
+            data.update(photo_fields(self.photo_id, thumbnail_size, photo))
+        if 'category' in embed:
+            data['_embedded'] = {'category': self.category.to_dict(
+                photo='none', fields=('id', 'name', 'description', '_links'))}
         return data
 
     def from_dict(self, data):
         for field in ['title', 'description', 'price', 'category_id']:
             if field in data:
                 setattr(self, field, data[field])
-            if 'photo_data' in data:
-                image = base64.b64decode(data['photo_data'])
-                self.photo_id = upload_photo(image)
+        if 'photo_data' in data:
+            image = base64.b64decode(data['photo_data'])
+            self.photo_id = upload_photo(image)
 
 
 class Category(PaginatedAPIMixin, db.Model):
@@ -197,7 +604,14 @@ class Category(PaginatedAPIMixin, db.Model):
     name = db.Column(db.String(64))
     description = db.Column(db.String(512))
     photo_id = db.Column(db.String(128))
+    version = db.Column(db.Integer, nullable=False, server_default='1')
+    updated_at = db.Column(db.DateTime, index=True, default=datetime.utcnow,
+                           onupdate=datetime.utcnow)
     items = db.relationship('Item', backref='category', lazy='dynamic')
+    __mapper_args__ = {'version_id_col': version}
+    __fields__ = ['id', 'name', 'description', 'items_count', '_links', 'photo']
+    __field_columns__ = {'items_count': [], '_links': [], 'photo': []}
+    __etag_columns__ = ['id', 'version', 'photo_id']
 
     def __repr__(self):
         return '<name:{} \n id:{}> \n photo_id:{}>'.format(self.name, self.id, self.photo_id)
@@ -205,32 +619,93 @@ class Category(PaginatedAPIMixin, db.Model):
     def get_items(self):
         return Item.query.filter_by(category_id=self.id)
 
-    def to_dict(self, to_collection=False):
+    def items_count(self):
+        if getattr(self, '_items_count', None) is None:
+            self._items_count = self.get_items().count()
+        return self._items_count
+
+    @classmethod
+    def prepare_collection(cls, categories, fields=None):
+        ids = [category.id for category in categories]
+        if not ids or not cls.wants('items_count', fields):
+            return
+        counts = dict(db.session.query(Item.category_id, db.func.count(Item.id))
+                      .filter(Item.category_id.in_(ids))
+                      .group_by(Item.category_id))
+        for category in categories:
+            category._items_count = counts.get(category.id, 0)
+
+    def etag_parts(self, fields=None, photo=None):
+        return self.id, self.version, \
+            self.wants('items_count', fields) and self.items_count(), \
+            self.wants('photo', fields, photo) and \
+            thumbnail_ready(self.photo_id)
+
+    def to_dict(self, to_collection=False, photo='inline', fields=None,
+                embed=()):
         thumbnail_size = 500
         if to_collection:
             thumbnail_size = 120
-        data = {
-            'id': self.id,
-            'name': self.name,
-            'description': self.description,
-            'items_count': self.get_items().count(),
-            'photo_data': self.get_thumbnail(self.photo_id, thumbnail_size, url=False),
-            '_links': {
-                'self': url_for('api.get_category', id=self.id),
-                'collection of categories': url_for('api.get_categories')
+        fields = fields or self.__fields__
+        data = {field: getattr(self, field) for field in
+                ('id', 'name', 'description') if field in fields}
+        if 'items_count' in fields:
+            data['items_count'] = self.items_count()
+        if '_links' in fields:
+            data['_links'] = {
+                'self': fast_url_for('api.get_category', id=self.id),
+                'collection of categories': fast_url_for('api.get_categories')
             }
-        }
+        if 'photo' in fields:
+            data.update(photo_fields(self.photo_id, thumbnail_size, photo))
         return data
 
     def from_dict(self, data):
         for field in ['name', 'description']:
             if field in data:
                 setattr(self, field, data[field])
-            if 'photo_data' in data:
-                image = base64.b64decode(data['photo_data'])
-                self.photo_id = upload_photo(image)
+        if 'photo_data' in data:
+            image = base64.b64decode(data['photo_data'])
+            self.photo_id = upload_photo(image)
+
+
+def release_photo(photo_id):
+    # Photos are content-addressed, so identical uploads share one file. It is
+    # only deleted once the release is committed and no committed row refers
+    # to it, so an upload of the same content that committed meanwhile (or in
+    # this same transaction) keeps it.
+    db.session.info.setdefault('released_photos', set()).add(photo_id)
+
+
+def delete_released_photos(session):
+    released = session.info.pop('released_photos', None)
+    if not released:
+        return
+    with db.engine.connect() as connection:
+        referenced = {photo_id for model in (Item, Category)
+                      for photo_id, in connection.execute(
+                          db.select([model.photo_id]).where(
+                              model.photo_id.in_(released)).distinct())}
+    for photo_id in released - referenced:
+        delete_photo(photo_id)
+
+
+def forget_released_photos(session):
+    session.info.pop('released_photos', None)
+
+
+db.event.listen(db.session, 'after_commit', delete_released_photos)
+db.event.listen(db.session, 'after_rollback', forget_released_photos)
 
 
 @login.user_loader
 def load_user(id):
-    return User.query.get(int(id))
\ No newline at end of file
+    key = identity_cache.key('session', id)
+    identity = identity_cache.get(key)
+    if identity is not None:
+        return User.from_identity(identity)
+    generation = identity_cache.generation()
+    user = User.query.options(db.load_only(*IDENTITY_FIELDS)).get(int(id))
+    if user is not None:
+        identity_cache.set(key, user.identity(), generation)
+    return user
\ No newline at end of file
@@ -1,28 +1,639 @@
+import re
+import threading
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from functools import partial
+from itertools import islice
+from time import monotonic, perf_counter
+from types import SimpleNamespace
+from elasticsearch import helpers
 from flask import current_app
+from sqlalchemy import Integer, and_, cast, column, func, table, text
+from sqlalchemy.orm import load_only
+from sqlalchemy.engine.url import make_url
+from app.cache import make_key, response_cache
 
 
-def add_to_index(index, model):
-    if not current_app.elasticsearch:
-        return
-    payload = {}
-    for field in model.__searchable__:
-        payload[field] = getattr(model, field)
-    current_app.elasticsearch.index(index=index, doc_type=index, id=model.id,
-                                    body=payload)
+def document(model):
+    return {field: getattr(model, field)
+            for field in model.__search_mapping__['properties']}
 
 
-def remove_from_index(index, model):
-    if not current_app.elasticsearch:
-        return
-    current_app.elasticsearch.delete(index=index, doc_type=index, id=model.id)
+def index_action(index, model):
+    return {'_index': index, '_id': model.id, '_source': document(model)}
+
 
+def remove_action(index, id):
+    return {'_op_type': 'delete', '_index': index, '_id': id}
 
-def query_index(index, query, page, per_page):
+
+def bulk_index(actions, chunk_size=None, refresh=False):
     if not current_app.elasticsearch:
-        return [], 0
-    search = current_app.elasticsearch.search(
-        index=index, doc_type=index,
-        body={'query': {'multi_match': {'query': query, 'fields': ['*']}},
-              'from': (page - 1) * per_page, 'size': per_page})
-    ids = [int(hit['_id']) for hit in search['hits']['hits']]
-    return ids, search['hits']['total']['value']
\ No newline at end of file
+        return 0, {}
+    indexed = 0
+    failed = {}
+    for ok, result in helpers.streaming_bulk(
+            current_app.elasticsearch, actions,
+            chunk_size=chunk_size or current_app.config['SEARCH_BULK_CHUNK_SIZE'],
+            max_retries=current_app.config['SEARCH_BULK_RETRIES'],
+            raise_on_error=False, raise_on_exception=False, refresh=refresh):
+        op_type, info = result.popitem()
+        if ok or op_type == 'delete' and info.get('status') == 404:
+            indexed += 1
+            continue
+        # Responses name the concrete index rather than the alias that was
+        # written to, so callers send one index per call and get ids back.
+        failed[str(info.get('_id'))] = info.get('error') or info.get('exception')
+        current_app.logger.error('Search indexing failed for %s/%s: %r',
+                                 info.get('_index'), info.get('_id'),
+                                 failed[str(info.get('_id'))])
+    return indexed, failed
+
+
+def reindex(index, query, chunk_size=None):
+    chunk_size = chunk_size or current_app.config['SEARCH_BULK_CHUNK_SIZE']
+    start = perf_counter()
+    indexed, failed = bulk_index((index_action(index, model)
+                                  for model in query.yield_per(chunk_size)),
+                                 chunk_size)
+    return indexed, len(failed), perf_counter() - start
+
+
+def id_slices(first, last, count):
+    step = max((last - first) // count + 1, 1)
+    return [(start, min(start + step - 1, last))
+            for start in range(first, last + 1, step)]
+
+
+def rebuild_alias(alias):
+    return alias + '-rebuild'
+
+
+def create_index(alias, mapping):
+    index = '{}-{}'.format(alias, datetime.utcnow().strftime('%Y%m%d%H%M%S%f'))
+    current_app.elasticsearch.indices.create(index=index, body={
+        'settings': {
+            'number_of_shards': current_app.config['SEARCH_INDEX_SHARDS'],
+            'number_of_replicas': 0,
+            'refresh_interval': '-1'},
+        'mappings': mapping,
+        'aliases': {rebuild_alias(alias): {}}})
+    return index
+
+
+def finish_index(index):
+    current_app.elasticsearch.indices.put_settings(index=index, body={
+        'index': {'number_of_replicas': current_app.config['SEARCH_INDEX_REPLICAS'],
+                  'refresh_interval': None}})
+    current_app.elasticsearch.indices.refresh(index=index)
+
+
+def swap_alias(alias, index):
+    indices = current_app.elasticsearch.indices
+    actions = []
+    old = []
+    if indices.exists_alias(name=alias):
+        old = list(indices.get_alias(name=alias))
+        actions = [{'remove': {'index': name, 'alias': alias}} for name in old]
+    elif indices.exists(index=alias):
+        # An index created implicitly before aliases were introduced.
+        actions = [{'remove_index': {'index': alias}}]
+    actions.append({'add': {'index': index, 'alias': alias}})
+    actions.append({'remove': {'index': index, 'alias': rebuild_alias(alias)}})
+    indices.update_aliases(body={'actions': actions})
+    return old
+
+
+def search_filters(model, args):
+    filters = {}
+    for name, facet in model.__search_facets__.items():
+        if facet['type'] == 'terms':
+            values = args.getlist(name, type=int)
+            if values:
+                filters[name] = values
+        else:
+            # _max is inclusive; _below excludes its bound, like the
+            # histogram buckets the facet links are built from.
+            bounds = tuple(args.get(name + suffix, type=float)
+                           for suffix in ('_min', '_max', '_below'))
+            if bounds != (None, None, None):
+                filters[name] = bounds
+    return filters
+
+
+def range_bounds(value):
+    return tuple(value) + (None,) * (3 - len(value))
+
+
+def facet_clause(name, facet, value):
+    if facet['type'] == 'terms':
+        return {'terms': {name: value}}
+    bounds = {}
+    for operator, bound in zip(('gte', 'lte', 'lt'), range_bounds(value)):
+        if bound is not None:
+            bounds[operator] = bound
+    return {'range': {name: bounds}}
+
+
+def facet_condition(field, facet, value):
+    if facet['type'] == 'terms':
+        return field.in_(value)
+    low, high, below = range_bounds(value)
+    conditions = []
+    if low is not None:
+        conditions.append(field >= low)
+    if high is not None:
+        conditions.append(field <= high)
+    if below is not None:
+        conditions.append(field < below)
+    return and_(*conditions)
+
+
+def reindex_slice(config, tablename, index, chunk_size, id_range):
+    from app import create_app
+    from app.models import SearchableMixin
+    app = create_app(SimpleNamespace(**config))
+    with app.app_context():
+        model = SearchableMixin.searchable_models()[tablename]
+        return model.reindex_range(index, id_range, chunk_size)
+
+
+class ElasticsearchBackend(object):
+    deferred = True
+
+    def update(self, index, models=(), removed_ids=()):
+        actions = [index_action(index, model) for model in models]
+        actions.extend(remove_action(index, id) for id in removed_ids)
+        # Wait for the changes to become searchable so the drain that follows
+        # only invalidates cached results once a new search would see them.
+        failed = bulk_index(actions, refresh='wait_for')[1]
+        # A running rebuild may already have copied a row deleted since; its
+        # catch-up pass only sees rows that still exist, so delete there too.
+        if removed_ids and current_app.elasticsearch.indices.exists_alias(
+                name=rebuild_alias(index)):
+            failed.update(bulk_index([remove_action(rebuild_alias(index), id)
+                                      for id in removed_ids])[1])
+        return failed
+
+    def search(self, model, expression, page, per_page, filters):
+        clauses = {name: facet_clause(name, model.__search_facets__[name], value)
+                   for name, value in filters.items()}
+        aggs = {}
+        for name, facet in model.__search_facets__.items():
+            # Each facet is counted with every filter except its own, so the
+            # other values of a filtered facet stay visible.
+            others = [clause for other, clause in clauses.items() if other != name]
+            if facet['type'] == 'terms':
+                buckets = {'terms': {'field': name, 'size': facet.get('size', 20)}}
+            else:
+                buckets = {'histogram': {'field': name, 'min_doc_count': 1,
+                                         'interval': facet['interval']}}
+            aggs[name] = {'filter': {'bool': {'filter': others}},
+                          'aggs': {'buckets': buckets}}
+        search = current_app.elasticsearch.search(index=model.__tablename__, body={
+            'query': {'multi_match': {'query': expression,
+                                      'fields': model.__searchable__}},
+            'post_filter': {'bool': {'filter': list(clauses.values())}},
+            'aggs': aggs,
+            'from': (page - 1) * per_page, 'size': per_page})
+        facets = {}
+        for name, facet in model.__search_facets__.items():
+            buckets = search['aggregations'][name]['buckets']['buckets']
+            if facet['type'] == 'terms':
+                facets[name] = [{'value': bucket['key'],
+                                 'count': bucket['doc_count']}
+                                for bucket in buckets]
+            else:
+                facets[name] = [{'from': bucket['key'],
+                                 'to': bucket['key'] + facet['interval'],
+                                 'count': bucket['doc_count']}
+                                for bucket in buckets]
+        return {'hits': [dict(hit['_source'], id=int(hit['_id']))
+                         for hit in search['hits']['hits']],
+                'total': search['hits']['total']['value'],
+                'facets': facets}
+
+    def suggest(self, model, expression, limit):
+        field = model.__suggest__
+        search = current_app.elasticsearch.search(index=model.__tablename__, body={
+            '_source': [field],
+            'suggest': {'suggestions': {
+                'prefix': expression,
+                'completion': {'field': field + '.suggest', 'size': limit,
+                               'skip_duplicates': True}}}})
+        return [{'id': int(option['_id']), field: option['_source'][field]}
+                for option in search['suggest']['suggestions'][0]['options']]
+
+    def rebuild(self, model, workers=1, chunk_size=None, keep_old=False):
+        alias = model.__tablename__
+        started = datetime.utcnow()
+        start = perf_counter()
+        index = create_index(alias, model.__search_mapping__)
+        first, last = model.query.with_entities(
+            func.min(model.id), func.max(model.id)).one()
+        slices = id_slices(first, last, workers * 4) if first is not None else []
+        if workers > 1:
+            fill = partial(reindex_slice, dict(current_app.config), alias, index,
+                           chunk_size)
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(fill, slices))
+        else:
+            results = [model.reindex_range(index, id_range, chunk_size)
+                       for id_range in slices]
+        # A slice may have read a row before it was edited; the outbox wrote
+        # that edit to the old index, so copy recent changes over as well.
+        results.append(reindex(index, model.search_query().filter(
+            model.updated_at >= started), chunk_size))
+        indexed = sum(result[0] for result in results)
+        failed = sum(result[1] for result in results)
+        if failed:
+            current_app.elasticsearch.indices.delete_alias(
+                index=index, name=rebuild_alias(alias))
+            raise RuntimeError('{} documents failed to index into {}; {} still '
+                               'points at the previous index'.format(
+                                   failed, index, alias))
+        finish_index(index)
+        for old_index in swap_alias(alias, index):
+            if not keep_old:
+                current_app.elasticsearch.indices.delete(index=old_index)
+        return indexed, index, perf_counter() - start
+
+
+class DatabaseBackend(object):
+    deferred = False
+
+    def __init__(self, text_config='english'):
+        self.text_config = text_config
+        self._tables = set()
+
+    def table(self, index):
+        return index + '_search'
+
+    def connection(self, index):
+        from app import db
+        from app.models import SearchableMixin
+        connection = db.session.connection()
+        if index not in self._tables:
+            name = self.table(index)
+            if connection.dialect.name == 'sqlite':
+                fields = SearchableMixin.searchable_models()[index].__searchable__
+                columns = [row[1] for row in connection.execute(
+                    'PRAGMA table_info({})'.format(name))]
+                if columns != fields:
+                    if columns:
+                        current_app.logger.warning(
+                            'Recreated %s for fields %s; run "flask search '
+                            'reindex" to refill it', name, ', '.join(fields))
+                        connection.execute('DROP TABLE {}'.format(name))
+                    connection.execute('CREATE VIRTUAL TABLE {} USING fts5({})'
+                                       .format(name, ', '.join(fields)))
+            else:
+                connection.execute('CREATE TABLE IF NOT EXISTS {} (id integer '
+                                   'PRIMARY KEY, document tsvector NOT NULL)'
+                                   .format(name))
+                connection.execute('CREATE INDEX IF NOT EXISTS ix_{0}_document '
+                                   'ON {0} USING gin (document)'.format(name))
+            self._tables.add(index)
+        return connection
+
+    def update(self, index, models=(), removed_ids=()):
+        connection = self.connection(index)
+        name = self.table(index)
+        models = list(models)
+        ids = [model.id for model in models] + list(removed_ids)
+        if connection.dialect.name == 'sqlite':
+            if ids:
+                connection.execute(text('DELETE FROM {} WHERE rowid = :id'.format(
+                    name)), [{'id': id} for id in ids])
+            if models:
+                fields = models[0].__searchable__
+                connection.execute(text('INSERT INTO {} (rowid, {}) VALUES '
+                                        '(:id, {})'.format(
+                                            name, ', '.join(fields),
+                                            ', '.join(':' + f for f in fields))),
+                                   [dict({f: getattr(model, f) for f in fields},
+                                         id=model.id) for model in models])
+            return {}
+        if removed_ids:
+            connection.execute(text('DELETE FROM {} WHERE id = :id'.format(name)),
+                               [{'id': id} for id in removed_ids])
+        if models:
+            connection.execute(text(
+                'INSERT INTO {} (id, document) VALUES '
+                '(:id, to_tsvector(CAST(:config AS regconfig), :document)) '
+                'ON CONFLICT (id) DO UPDATE SET document = excluded.document'
+                .format(name)), [{
+                    'id': model.id, 'config': self.text_config,
+                    'document': ' '.join(str(getattr(model, field))
+                                         for field in model.__searchable__
+                                         if getattr(model, field) is not None)}
+                    for model in models])
+        return {}
+
+    def search(self, model, expression, page, per_page, filters):
+        connection = self.connection(model.__tablename__)
+        name = self.table(model.__tablename__)
+        sqlite = connection.dialect.name == 'sqlite'
+        if sqlite:
+            # Quote every term so user input is never parsed as FTS5 syntax.
+            match = ' '.join('"{}"'.format(term.replace('"', '""'))
+                             for term in expression.split())
+            if not match:
+                return {'hits': [], 'total': 0,
+                        'facets': {facet: [] for facet in model.__search_facets__}}
+            fts = table(name, column('rowid'), column('rank'))
+            query = model.query.join(fts, fts.c.rowid == model.id) \
+                .filter(text(name + ' MATCH :match')).params(match=match)
+            rank = fts.c.rank
+        else:
+            fts = table(name, column('id'), column('document'))
+            tsquery = func.plainto_tsquery(self.text_config, expression)
+            query = model.query.join(fts, fts.c.id == model.id) \
+                .filter(fts.c.document.op('@@')(tsquery))
+            rank = func.ts_rank(fts.c.document, tsquery).desc()
+
+        def filtered(exclude=None):
+            result = query
+            for facet_name, value in filters.items():
+                if facet_name != exclude:
+                    result = result.filter(facet_condition(
+                        getattr(model, facet_name),
+                        model.__search_facets__[facet_name], value))
+            return result
+
+        hits = filtered().options(load_only(*model.__search_mapping__['properties'])) \
+            .order_by(rank, model.id).offset((page - 1) * per_page).limit(per_page)
+        facets = {}
+        for facet_name, facet in model.__search_facets__.items():
+            field = getattr(model, facet_name)
+            if facet['type'] == 'terms':
+                count = func.count(model.id)
+                rows = filtered(facet_name).with_entities(field, count) \
+                    .filter(field.isnot(None)).group_by(field) \
+                    .order_by(count.desc(), field).limit(facet.get('size', 20))
+                facets[facet_name] = [{'value': value, 'count': count}
+                                      for value, count in rows]
+            else:
+                interval = facet['interval']
+                bucket = cast(field / interval, Integer) if sqlite else \
+                    func.floor(field / interval)
+                rows = filtered(facet_name).with_entities(bucket, func.count(model.id)) \
+                    .filter(field.isnot(None)).group_by(bucket).order_by(bucket)
+                facets[facet_name] = [{'from': value * interval,
+                                       'to': (value + 1) * interval,
+                                       'count': count} for value, count in rows]
+        return {'hits': [dict(document(obj), id=obj.id) for obj in hits],
+                'total': filtered().order_by(None).count(),
+                'facets': facets}
+
+    def suggest(self, model, expression, limit):
+        return prefix_index.suggest(model, expression, limit)
+
+    def rebuild(self, model, workers=1, chunk_size=None, keep_old=False):
+        from app import db
+        index = model.__tablename__
+        chunk_size = chunk_size or current_app.config['SEARCH_BULK_CHUNK_SIZE']
+        start = perf_counter()
+        self.connection(index).execute('DELETE FROM {}'.format(self.table(index)))
+        indexed = 0
+        batch = []
+        for obj in model.search_query().yield_per(chunk_size):
+            batch.append(obj)
+            if len(batch) == chunk_size:
+                self.update(index, batch)
+                indexed += len(batch)
+                batch = []
+        self.update(index, batch)
+        indexed += len(batch)
+        db.session.commit()
+        return indexed, self.table(index), perf_counter() - start
+
+
+class PrefixIndex(object):
+    # Each index is (built_at, entries, values). Readers only use the sorted
+    # entries, which updates replace as a whole; values maps ids to indexed
+    # titles and is only touched under the lock.
+
+    def __init__(self):
+        self._indexes = {}
+        self._pending = {}
+        self._building = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def entries(id, value):
+        return [(word, value, id) for word in set(WORD.findall(value.lower()))] \
+            if value else []
+
+    def build(self, model):
+        field = getattr(model, model.__suggest__)
+        values = dict(model.query.with_entities(model.id, field)
+                      .filter(field.isnot(None)))
+        entries = sorted(entry for id, value in values.items()
+                         for entry in self.entries(id, value))
+        return monotonic(), entries, values
+
+    def apply(self, model, index, ids):
+        field = getattr(model, model.__suggest__)
+        current = dict(model.query.with_entities(model.id, field)
+                       .filter(model.id.in_(ids)))
+        built, entries, values = index
+        changed = [id for id in ids if current.get(id) != values.get(id)]
+        if not changed:
+            return index
+        entries = list(entries)
+        for id in changed:
+            for entry in self.entries(id, values.pop(id, None)):
+                del entries[bisect_left(entries, entry)]
+            if current.get(id):
+                values[id] = current[id]
+                for entry in self.entries(id, current[id]):
+                    entries.insert(bisect_left(entries, entry), entry)
+        return built, entries, values
+
+    def changed(self, tablename, ids):
+        with self._lock:
+            if tablename in self._indexes:
+                self._pending.setdefault(tablename, set()).update(ids)
+            if tablename in self._building:
+                self._building[tablename].update(ids)
+
+    def get(self, model):
+        name = model.__tablename__
+        index = self._indexes.get(name)
+        if index is None:
+            with self._lock:
+                index = self._indexes.get(name)
+                if index is None:
+                    index = self._indexes[name] = self.build(model)
+        with self._lock:
+            pending = self._pending.pop(name, None)
+            # Commits made by this process patch the index in place; a large
+            # batch, and anything other workers changed (bounded by the TTL),
+            # is picked up by a rebuild that runs while the old index serves.
+            if pending and len(pending) <= max(1000, len(index[2]) // 10):
+                index = self._indexes[name] = self.apply(
+                    model, self._indexes[name], pending)
+                pending = None
+        if pending or \
+                index[0] + current_app.config['SUGGEST_INDEX_TTL'] < monotonic():
+            self.rebuild_later(model)
+        return index[1]
+
+    def rebuild_later(self, model):
+        name = model.__tablename__
+        with self._lock:
+            if name in self._building:
+                return
+            self._building[name] = set()
+        threading.Thread(target=self.rebuild, daemon=True, args=(
+            current_app._get_current_object(), model)).start()
+
+    def rebuild(self, app, model):
+        from app import db
+        name = model.__tablename__
+        index = None
+        try:
+            with app.app_context():
+                try:
+                    index = self.build(model)
+                finally:
+                    db.session.remove()
+        except Exception:
+            app.logger.exception('Rebuilding the %s prefix index failed', name)
+        with self._lock:
+            changed = self._building.pop(name)
+            if index is not None:
+                self._indexes[name] = index
+                # Commits that landed while the rows were being read.
+                if changed:
+                    self._pending.setdefault(name, set()).update(changed)
+
+    def suggest(self, model, expression, limit):
+        words = WORD.findall(expression.lower())
+        if not words:
+            return []
+        prefix, required = words[-1], set(words[:-1])
+        entries = self.get(model)
+        field = model.__suggest__
+        suggestions = []
+        seen = set()
+        for word, value, id in islice(entries, bisect_left(entries, (prefix,)),
+                                      None):
+            if not word.startswith(prefix):
+                break
+            if id in seen or required and \
+                    not required <= set(WORD.findall(value.lower())):
+                continue
+            seen.add(id)
+            suggestions.append({'id': id, field: value})
+            if len(suggestions) == limit:
+                break
+        return suggestions
+
+    def clear(self):
+        with self._lock:
+            self._indexes.clear()
+            self._pending.clear()
+
+
+WORD = re.compile(r'\w+')
+prefix_index = PrefixIndex()
+
+
+def include_object(object, name, type_, reflected, compare_to):
+    # Full-text tables (and FTS5 shadow tables) are created at runtime by
+    # DatabaseBackend; keep autogenerate from dropping them.
+    return not (type_ == 'table' and reflected and compare_to is None and
+                re.search(r'_search(_(data|idx|content|docsize|config))?$', name))
+
+
+def create_search_backend(config):
+    prefix_index.clear()
+    backend = config['SEARCH_BACKEND']
+    if backend == 'auto':
+        if config['ELASTICSEARCH_URL']:
+            backend = 'elasticsearch'
+        elif make_url(config['SQLALCHEMY_DATABASE_URI']).get_backend_name() in \
+                ('sqlite', 'postgresql'):
+            backend = 'database'
+    if backend == 'elasticsearch':
+        return ElasticsearchBackend()
+    if backend == 'database':
+        return DatabaseBackend(config['SEARCH_TEXT_CONFIG'])
+    return None
+
+
+def query_index(model, expression, page, per_page, filters=None):
+    if not current_app.search_backend:
+        return {'hits': [], 'total': 0, 'facets': {}}
+    filters = filters or {}
+    if not response_cache.enabled:
+        return current_app.search_backend.search(model, expression, page,
+                                                 per_page, filters)
+    # Commits to the table bump its generation; the outbox drain and alias
+    # swaps bump 'search:<table>' once Elasticsearch has caught up. Without
+    # Redis those bumps stay in the draining process, so other processes only
+    # keep results for SEARCH_CACHE_TTL.
+    key = make_key('search', model.__tablename__,
+                   ' '.join(expression.lower().split()), page, per_page,
+                   sorted(filters.items()), response_cache.generations(
+                       (model.__tablename__, 'search:' + model.__tablename__)))
+    results = response_cache.get(key)
+    if results is None:
+        results = current_app.search_backend.search(model, expression, page,
+                                                    per_page, filters)
+        response_cache.set(key, results, None if response_cache.redis else
+                           current_app.config['SEARCH_CACHE_TTL'])
+    return results
+
+
+def suggest_index(model, expression, limit):
+    if not expression.strip():
+        return []
+    return (current_app.search_backend or prefix_index).suggest(
+        model, expression, limit)
+
+
+class SearchIndexer(object):
+    def __init__(self):
+        self.app = None
+        self.enabled = False
+        self.batch_size = 500
+        self.interval = 5
+        self._thread = None
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config['SEARCH_INDEXER_THREAD']
+        self.batch_size = app.config['SEARCH_BULK_CHUNK_SIZE']
+        self.interval = app.config['SEARCH_INDEXER_INTERVAL']
+
+    def wake(self):
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.run,
+                                                name='search-indexer',
+                                                daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+    def run(self):
+        from app.models import SearchOutbox
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            with self.app.app_context():
+                try:
+                    while SearchOutbox.drain(self.batch_size):
+                        pass
+                except Exception:
+                    self.app.logger.exception('Search outbox drain failed')
+
+
+search_indexer = SearchIndexer()
@@ -0,0 +1,74 @@
+import json
+from flask import _request_ctx_stack, current_app, url_for
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+URL_PLACEHOLDER = 987654321
+_url_templates = {}
+
+
+def encoder_default(obj):
+    return current_app.json_encoder().default(obj)
+
+
+def dumps(data):
+    if orjson is not None:
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if current_app.config['JSON_SORT_KEYS']:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(data, default=encoder_default, option=option)
+    return json.dumps(data, cls=current_app.json_encoder, separators=(',', ':'),
+                      sort_keys=current_app.config['JSON_SORT_KEYS'],
+                      ensure_ascii=current_app.config['JSON_AS_ASCII']) \
+        .encode('utf-8')
+
+
+def json_response(data, status=200):
+    return current_app.response_class(
+        dumps(data) + b'\n', status=status,
+        mimetype=current_app.config['JSONIFY_MIMETYPE'])
+
+
+def stream_json_array(rows, chunk_size=1000):
+    yield b'['
+    chunk = []
+    for number, row in enumerate(rows):
+        chunk.append(dumps(row))
+        if len(chunk) == chunk_size:
+            yield (b',' if number >= chunk_size else b'') + b','.join(chunk)
+            chunk = []
+    if chunk:
+        yield (b',' if number >= chunk_size else b'') + b','.join(chunk)
+    yield b']\n'
+
+
+def stream_json_lines(rows, chunk_size=1000):
+    chunk = []
+    for row in rows:
+        chunk.append(dumps(row))
+        if len(chunk) == chunk_size:
+            yield b'\n'.join(chunk) + b'\n'
+            chunk = []
+    if chunk:
+        yield b'\n'.join(chunk) + b'\n'
+
+
+def fast_url_for(endpoint, **values):
+    # Builds the URL through the routing map once per endpoint and reuses it
+    # as a format string; only for integer (or otherwise URL-safe) values.
+    ctx = _request_ctx_stack.top
+    key = (endpoint, tuple(values), ctx.request.script_root if ctx else None)
+    template = _url_templates.get(key)
+    if template is None:
+        placeholders = {name: URL_PLACEHOLDER + i
+                        for i, name in enumerate(values)}
+        template = url_for(endpoint, **placeholders).replace('{', '{{') \
+            .replace('}', '}}')
+        for name, placeholder in placeholders.items():
+            template = template.replace(str(placeholder), '{' + name + '}')
+        _url_templates[key] = template
+    return template.format(**values)
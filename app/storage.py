@@ -0,0 +1,186 @@
+import mimetypes
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from flask import current_app, url_for
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+class FileSystemStorage(object):
+    def __init__(self, root, url_prefix=None):
+        self.root = root
+        self.url_prefix = url_prefix
+
+    def path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def save(self, stream, key):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                shutil.copyfileobj(stream, f, CHUNK_SIZE)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def open(self, key):
+        return open(self.path(key), 'rb')
+
+    def exists(self, key, cached=True):
+        return os.path.exists(self.path(key))
+
+    def forget(self, key):
+        pass
+
+    def version(self, key):
+        try:
+            return os.stat(self.path(key)).st_mtime_ns
+        except OSError:
+            return None
+
+    def delete(self, key):
+        if self.exists(key):
+            os.remove(self.path(key))
+
+    @contextmanager
+    def local_path(self, key):
+        yield self.path(key)
+
+    def url(self, key):
+        if self.url_prefix:
+            return self.url_prefix + key
+        static_dir = os.path.relpath(self.root, current_app.static_folder)
+        return url_for('static', filename=static_dir.replace(os.sep, '/') +
+                       '/' + key)
+
+
+class S3Storage(object):
+    def __init__(self, bucket, prefix='', endpoint_url=None, region=None,
+                 url_prefix=None, url_expires=3600, head_cache_size=10000,
+                 head_cache_ttl=30, miss_cache_ttl=5):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.endpoint_url = endpoint_url
+        self.region = region
+        self.url_prefix = url_prefix
+        self.url_expires = url_expires
+        self.head_cache_size = head_cache_size
+        self.head_cache_ttl = head_cache_ttl
+        self.miss_cache_ttl = miss_cache_ttl
+        self._client = None
+        self._heads = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(_client=None, _heads=OrderedDict(), _lock=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            try:
+                import boto3
+            except ImportError:
+                raise RuntimeError('S3 photo storage requires boto3')
+            self._client = boto3.client('s3', endpoint_url=self.endpoint_url,
+                                        region_name=self.region)
+        return self._client
+
+    def save(self, stream, key):
+        content_type = mimetypes.guess_type(key)[0] or 'application/octet-stream'
+        self.client.upload_fileobj(stream, self.bucket, self.prefix + key,
+                                   ExtraArgs={'ContentType': content_type})
+        self.forget(key)
+
+    def open(self, key):
+        return self.client.get_object(Bucket=self.bucket,
+                                      Key=self.prefix + key)['Body']
+
+    def _head(self, key, cached=True):
+        # Objects are content-addressed and never rewritten in place, so a
+        # positive HEAD result stays valid until the key is deleted; the TTL
+        # bounds how long a delete made by another node goes unnoticed.
+        # Misses, mostly thumbnails still being generated, are kept briefly
+        # and dropped as soon as this process writes or is told of the key.
+        if cached:
+            with self._lock:
+                expires, head = self._heads.get(key, (0, None))
+                if expires > time.time():
+                    self._heads.move_to_end(key)
+                    return head
+        try:
+            head = self.client.head_object(Bucket=self.bucket,
+                                           Key=self.prefix + key)
+        except self.client.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                self._remember(key, None, self.miss_cache_ttl)
+                return None
+            raise
+        self._remember(key, head, self.head_cache_ttl)
+        return head
+
+    def _remember(self, key, head, ttl):
+        with self._lock:
+            self._heads[key] = (time.time() + ttl, head)
+            self._heads.move_to_end(key)
+            while len(self._heads) > self.head_cache_size:
+                self._heads.popitem(last=False)
+
+    def forget(self, key):
+        with self._lock:
+            self._heads.pop(key, None)
+
+    def exists(self, key, cached=True):
+        return self._head(key, cached) is not None
+
+    def version(self, key):
+        head = self._head(key)
+        return head['ETag'] if head else None
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self.prefix + key)
+        self.forget(key)
+
+    @contextmanager
+    def local_path(self, key):
+        fd, path = tempfile.mkstemp(suffix=os.path.splitext(key)[1])
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                self.client.download_fileobj(self.bucket, self.prefix + key, f)
+            yield path
+        finally:
+            os.remove(path)
+
+    def url(self, key):
+        if self.url_prefix:
+            return self.url_prefix + key
+        return self.client.generate_presigned_url(
+            'get_object', Params={'Bucket': self.bucket, 'Key': self.prefix + key},
+            ExpiresIn=self.url_expires)
+
+
+def create_storage(config):
+    if config['PHOTO_STORAGE'] == 's3':
+        return S3Storage(config['S3_BUCKET'], prefix=config['S3_PREFIX'],
+                         endpoint_url=config['S3_ENDPOINT_URL'],
+                         region=config['S3_REGION'],
+                         url_prefix=config['PHOTO_URL_PREFIX'],
+                         url_expires=config['S3_URL_EXPIRES'],
+                         head_cache_ttl=config['S3_HEAD_CACHE_TTL'],
+                         miss_cache_ttl=config['S3_HEAD_MISS_TTL'])
+    return FileSystemStorage(config['PHOTO_ROOT'],
+                             url_prefix=config['PHOTO_URL_PREFIX'])
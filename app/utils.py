@@ -1,73 +1,347 @@
 import base64
+import hashlib
+import io
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing
 from functools import wraps
 from flask_login import current_user
 from werkzeug.exceptions import abort
 from werkzeug.utils import secure_filename
 import os
-from flask import flash, url_for
+from flask import current_app, flash, g, url_for
 import re
-from config import imagedir
 from PIL import Image
+from app.cache import response_cache
+
+
+CONTENT_ADDRESSED_PHOTO_ID = re.compile(r'^[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}\.\w+$')
+UPLOAD_SPOOL_SIZE = 8 * 1024 * 1024
+
+
+def photo_key(digest, extension):
+    return '{}/{}/{}{}'.format(digest[:2], digest[2:4], digest, extension)
+
+
+def store_photo(stream, filename='', storage=None):
+    storage = storage or current_app.storage
+    extension = os.path.splitext(secure_filename(filename))[1].lower()
+    digest = hashlib.sha256()
+    with tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_SIZE) as spool:
+        for chunk in iter(lambda: stream.read(64 * 1024), b''):
+            digest.update(chunk)
+            spool.write(chunk)
+        spool.seek(0)
+        if not extension:
+            with Image.open(spool) as img:
+                extension = {'JPEG': '.jpg'}.get(
+                    img.format, '.' + img.format.lower())
+            spool.seek(0)
+        photo_id = photo_key(digest.hexdigest(), extension)
+        # Skip the cached existence check: another node may have just
+        # deleted the object this upload would otherwise rely on.
+        if not storage.exists(photo_id, cached=False):
+            storage.save(spool, photo_id)
+    if not storage.exists(thumbnail_key(photo_id, min(thumbnail_queue.sizes))):
+        thumbnail_queue.submit(photo_id, storage)
+    return photo_id
 
 
 def upload_photo(image_data):
-    filename = secure_filename(image_data.filename)
-    same_filename_count = 0
-    base = os.path.splitext(filename)
-    original_name, extension = base[0], base[1]
-    re.sub(r'\(\d+\)$', '', original_name)
-    while filename in os.listdir(path=imagedir):
-        filename = original_name + '(' + str(same_filename_count) + ')' + extension
-        same_filename_count += 1
-    filepath = (os.path.join(imagedir, filename))
-    image_data.save(filepath)
-    make_thumbnail((500, 500), filepath)
-    make_thumbnail((120, 120), filepath)
+    if isinstance(image_data, bytes):
+        photo_id = store_photo(io.BytesIO(image_data))
+    else:
+        photo_id = store_photo(image_data.stream, image_data.filename)
     flash('Photo was uploaded!')
-    return filename
+    return photo_id
+
+
+def delete_photo(photo_id, storage=None):
+    storage = storage or current_app.storage
+    if storage.exists(photo_id):
+        storage.delete(photo_id)
+        delete_thumbnails(photo_id, storage)
+
+
+def thumbnail_ready(photo_id):
+    return photo_id is None or current_app.storage.exists(
+        thumbnail_key(photo_id, min(thumbnail_queue.sizes)))
+
+
+def thumbnail_key(photo_id, size, extension=None):
+    filename, original_extension = os.path.splitext(photo_id)
+    return 'thumbnails/' + filename + '_thumbnail' + str(size) + \
+        (extension or original_extension)
+
+
+def image_format(key):
+    return Image.registered_extensions().get(os.path.splitext(key)[1].lower())
+
+
+def thumbnail_keys(photo_id, sizes=None):
+    extensions = [None] + [DERIVATIVE_EXTENSIONS[img_format]
+                           for img_format in thumbnail_queue.formats]
+    return [thumbnail_key(photo_id, size, extension)
+            for size in sizes or thumbnail_queue.sizes
+            for extension in extensions]
+
+
+def delete_thumbnails(photo_id, storage, sizes=None):
+    for key in thumbnail_keys(photo_id, sizes):
+        storage.delete(key)
+
+
+DERIVATIVE_EXTENSIONS = {'WEBP': '.webp', 'JPEG': '.jpg'}
+
+
+def save_thumbnail(img, storage, key, img_format, options):
+    if img_format == 'JPEG' and img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+    buffer = io.BytesIO()
+    img.save(buffer, format=img_format, **options)
+    buffer.seek(0)
+    storage.save(buffer, key)
+
 
+def make_thumbnails(filepath, sizes, storage, formats=None, photo_id=None):
+    photo_id = photo_id or os.path.basename(filepath)
+    sizes = sorted(sizes, reverse=True)
+    formats = formats or {}
+    with Image.open(filepath) as img:
+        img_format = img.format
+        has_alpha = 'A' in img.getbands() or 'transparency' in img.info
+        # Let the JPEG decoder scale down by 1/2..1/8 while decoding and shrink
+        # other formats with a cheap box reduce before the first resample.
+        img.draft(None, (sizes[0] * 2, sizes[0] * 2))
+        # reduce() (also used inside thumbnail()) has no palette, bilevel or
+        # 16-bit mode; those resample as RGB(A) or 8-bit greyscale instead.
+        if img.mode == 'P':
+            img = img.convert('RGBA' if has_alpha else 'RGB')
+        elif img.mode == '1':
+            img = img.convert('L')
+        elif img.mode.startswith('I;16'):
+            img = img.convert('I').point(lambda value: value / 256) \
+                .convert('L')
+        factor = min(img.size[0], img.size[1]) // (sizes[0] * 2)
+        if factor > 1:
+            img = img.reduce(factor)
+        for size in sizes:
+            img.thumbnail((size, size))
+            for derivative_format, options in formats.items():
+                if derivative_format == img_format or \
+                        derivative_format == 'JPEG' and has_alpha:
+                    continue
+                save_thumbnail(img, storage, thumbnail_key(
+                    photo_id, size, DERIVATIVE_EXTENSIONS[derivative_format]),
+                    derivative_format, options)
+            # The original-format thumbnail goes last: once it exists, so do
+            # all of its derivatives.
+            save_thumbnail(img, storage, thumbnail_key(photo_id, size),
+                           img_format, formats.get(img_format, {}))
 
-def delete_photo(photo_id):
-    filepath = os.path.join(imagedir, photo_id)
-    if os.path.exists(filepath):
-        os.remove(filepath)
-        delete_thumbnails(photo_id)
 
+def generate_thumbnails(photo_id, storage, sizes, formats=None, retries=3,
+                        backoff=0.5):
+    for attempt in range(retries + 1):
+        try:
+            if not storage.exists(photo_id):
+                return False
+            with storage.local_path(photo_id) as filepath:
+                make_thumbnails(filepath, sizes, storage, formats, photo_id)
+            return True
+        except Exception:
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** attempt)
 
-def delete_thumbnails(photo_id, fsize=500, ssize=120):
-    thumbnaildir = os.path.join(imagedir, 'thumbnails')
-    original_filename, extension = os.path.splitext(photo_id)
-    first_tmb_filename = original_filename + '_thumbnail' + str(fsize) + extension
-    second_tmb_filename = original_filename + '_thumbnail' + str(ssize) + extension
-    os.remove(os.path.join(thumbnaildir, first_tmb_filename))
-    os.remove(os.path.join(thumbnaildir, second_tmb_filename))
 
+class ThumbnailQueue(object):
+    def __init__(self):
+        self.workers = 0
+        self.sizes = [500, 120]
+        self.formats = {}
+        self.retries = 3
+        self.backoff = 0.5
+        self.logger = None
+        self._executor = None
+        self._lock = threading.Lock()
 
-def make_thumbnail(size, filepath):
-    filename, extension = os.path.splitext(os.path.basename(filepath))
-    img = Image.open(filepath)
-    img.thumbnail(size)
-    os.chdir(os.path.join(imagedir, 'thumbnails'))
-    filename = filename + '_thumbnail' + str(size[0]) + extension
-    img.save(filename)
+    def init_app(self, app):
+        self.workers = app.config['THUMBNAIL_WORKERS']
+        self.sizes = app.config['THUMBNAIL_SIZES']
+        self.formats = app.config['THUMBNAIL_FORMATS']
+        self.retries = app.config['THUMBNAIL_RETRIES']
+        self.backoff = app.config['THUMBNAIL_RETRY_BACKOFF']
+        self.logger = app.logger
+
+    def submit(self, photo_id, storage):
+        if self.workers:
+            try:
+                future = self._get_executor().submit(
+                    generate_thumbnails, photo_id, storage, self.sizes,
+                    self.formats, self.retries, self.backoff)
+            except RuntimeError:
+                self.logger.exception('Thumbnail pool is unavailable, '
+                                      'generating in-process')
+            else:
+                future.add_done_callback(
+                    lambda f: self._report(photo_id, storage, f.exception()))
+                return
+        # Without a pool the first attempt runs inline so the thumbnail is
+        # there when the request returns; retries back off on a thread rather
+        # than holding up the request.
+        try:
+            generate_thumbnails(photo_id, storage, self.sizes, self.formats,
+                                retries=0)
+        except Exception as e:
+            if not self.retries:
+                self._report(photo_id, storage, e)
+                return
+            threading.Thread(target=self._retry, args=(photo_id, storage),
+                             daemon=True).start()
+        else:
+            self._report(photo_id, storage, None)
+
+    def _retry(self, photo_id, storage):
+        time.sleep(self.backoff)
+        try:
+            generate_thumbnails(photo_id, storage, self.sizes, self.formats,
+                                self.retries - 1, self.backoff * 2)
+        except Exception as e:
+            self._report(photo_id, storage, e)
+        else:
+            self._report(photo_id, storage, None)
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            return self._executor
+
+    def _report(self, photo_id, storage, error):
+        if error is None:
+            # Pool workers write through their own copy of the storage, so
+            # drop the misses this process cached while they were running.
+            for key in thumbnail_keys(photo_id):
+                storage.forget(key)
+            # Cached pages and payloads show the placeholder until the
+            # thumbnails exist, so drop them once they do.
+            response_cache.invalidate('item', 'category')
+        elif self.logger:
+            self.logger.error('Thumbnail generation failed for %s: %r',
+                              photo_id, error)
+
+
+thumbnail_queue = ThumbnailQueue()
+
+
+PHOTO_MODES = ('inline', 'url', 'none')
+
+
+class ThumbnailPayloadCache(object):
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._payloads = OrderedDict()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.max_bytes = app.config['THUMBNAIL_CACHE_BYTES']
+
+    def get(self, storage, key):
+        version = storage.version(key)
+        if version is None:
+            return None
+        with self._lock:
+            payload = self._payloads.get((key, version))
+            if payload is not None:
+                self._payloads.move_to_end((key, version))
+                return payload
+        with closing(storage.open(key)) as f:
+            payload = base64.b64encode(f.read()).decode('ascii')
+        self._put((key, version), payload)
+        return payload
+
+    def _put(self, key, payload):
+        if len(payload) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._payloads:
+                return
+            self._payloads[key] = payload
+            self.size += len(payload)
+            while self.size > self.max_bytes:
+                _, evicted = self._payloads.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._payloads.clear()
+            self.size = 0
+
+
+thumbnail_payloads = ThumbnailPayloadCache()
 
 
 def get_thumbnail(photo_id, size, url=True):
-    filename, extension = os.path.splitext(photo_id)
-    thumbnail_name = filename + '_thumbnail' + str(size) + extension
+    storage = current_app.storage
+    key = thumbnail_key(photo_id, size)
     if url:
-        return url_for('static', filename='images/thumbnails/' + thumbnail_name)
-    image = Image.open(os.path.join(imagedir, 'thumbnails', thumbnail_name))
-    return base64.encode(image)
+        if not storage.exists(key):
+            return url_for('static', filename='placeholder.svg')
+        return storage.url(key)
+    return thumbnail_payloads.get(storage, key)
+
+
+def get_picture(photo_id, size):
+    storage = current_app.storage
+    primary = thumbnail_key(photo_id, size)
+    if not storage.exists(primary):
+        return {'src': url_for('static', filename='placeholder.svg'),
+                'srcset': None, 'sources': []}
+    densities = [(size, '1x')]
+    if size * 2 in thumbnail_queue.sizes:
+        densities.append((size * 2, '2x'))
+
+    def srcset(extension=None):
+        candidates = []
+        for density_size, descriptor in densities:
+            key = thumbnail_key(photo_id, density_size, extension)
+            if storage.exists(key):
+                candidates.append(storage.url(key) + ' ' + descriptor)
+        return ', '.join(candidates)
+
+    sources = []
+    for img_format in thumbnail_queue.formats:
+        if img_format == image_format(primary):
+            continue
+        candidates = srcset(DERIVATIVE_EXTENSIONS[img_format])
+        if candidates:
+            sources.append({'type': Image.MIME[img_format], 'srcset': candidates})
+    return {'src': storage.url(primary), 'srcset': srcset() or None,
+            'sources': sources}
+
+
+def photo_fields(photo_id, size, photo='inline'):
+    if photo == 'url':
+        return {'photo_url': get_thumbnail(photo_id, size) if photo_id else None}
+    if photo == 'inline':
+        return {'photo_data': get_thumbnail(photo_id, size, url=False)
+                if photo_id else None}
+    return {}
 
 
 def permission_required(permission):
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
-            if current_user.permission == 'admin':
+            user = g.get('current_user') or current_user
+            if user.permission == 'admin':
                 return f(*args, **kwargs)
-            if current_user.permission != permission:
+            if user.permission != permission:
                 abort(403)
             return f(*args, **kwargs)
         return decorated_function
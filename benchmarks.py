@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+import argparse
+import os
+import random
+import tempfile
+import time
+from PIL import Image
+from app.storage import FileSystemStorage
+from app.utils import make_thumbnails
+
+
+def legacy_make_thumbnail(size, filepath, thumbnaildir):
+    filename, extension = os.path.splitext(os.path.basename(filepath))
+    img = Image.open(filepath)
+    img.thumbnail(size)
+    os.chdir(thumbnaildir)
+    filename = filename + '_thumbnail' + str(size[0]) + extension
+    img.save(filename)
+
+
+def generate_images(directory, count, width, height):
+    paths = []
+    for i in range(count):
+        img = Image.merge('RGB', [
+            Image.linear_gradient('L').resize((width, height)),
+            Image.effect_noise((width, height), 64),
+            Image.radial_gradient('L').resize((width, height))])
+        extension = '.png' if i % 4 == 3 else '.jpg'
+        path = os.path.join(directory, 'photo{}{}'.format(i, extension))
+        img.save(path)
+        paths.append(path)
+    return paths
+
+
+def bench_thumbnails(args):
+    sizes = [int(size) for size in args.sizes.split(',')]
+    width, height = (int(x) for x in args.resolution.split('x'))
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        thumbnaildir = os.path.join(directory, 'thumbnails')
+        os.mkdir(thumbnaildir)
+        paths = generate_images(directory, args.images, width, height)
+
+        start = time.perf_counter()
+        for path in paths:
+            for size in sizes:
+                legacy_make_thumbnail((size, size), path, thumbnaildir)
+        legacy = time.perf_counter() - start
+        os.chdir(cwd)
+
+        storage = FileSystemStorage(directory)
+        start = time.perf_counter()
+        for path in paths:
+            make_thumbnails(path, sizes, storage)
+        current = time.perf_counter() - start
+
+    print('{} images {}x{}, sizes {}'.format(len(paths), width, height, sizes))
+    print('make_thumbnail (legacy): {:8.1f} images/s'.format(len(paths) / legacy))
+    print('make_thumbnails:         {:8.1f} images/s'.format(len(paths) / current))
+    print('speedup:                 {:8.2f}x'.format(legacy / current))
+
+
+def bench_suggest(args):
+    from app import create_app, db
+    from app.models import Category, Item
+    from config import Config
+
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = 'sqlite://'
+        SEARCH_BACKEND = 'none'
+
+    rng = random.Random(0)
+    words = ['{}{}'.format(rng.choice('abcdefghijklmnopqrstuvwxyz'), i)
+             for i in range(2000)]
+    app = create_app(BenchConfig)
+    with app.app_context():
+        db.create_all()
+        category = Category(name='BENCH')
+        db.session.add(category)
+        db.session.commit()
+        db.session.bulk_insert_mappings(Item, [
+            {'title': ' '.join(rng.sample(words, 3)), 'price': 1.0,
+             'category_id': category.id} for i in range(args.items)])
+        db.session.commit()
+        start = time.perf_counter()
+        Item.suggest('a')
+        print('{} items, index built in {:.1f} ms'.format(
+            args.items, (time.perf_counter() - start) * 1000))
+        timings = []
+        items = Item.query.limit(100).all()
+        for i in range(args.queries):
+            if args.write_every and i % args.write_every == 0:
+                item = rng.choice(items)
+                item.price += 1
+                if i % (args.write_every * 10) == 0:
+                    item.title = ' '.join(rng.sample(words, 3))
+                db.session.commit()
+            word = rng.choice(words)
+            prefix = word[:rng.randint(1, len(word))]
+            start = time.perf_counter()
+            Item.suggest(prefix)
+            timings.append(time.perf_counter() - start)
+        timings.sort()
+        for label, quantile in (('p50', 0.5), ('p99', 0.99)):
+            print('suggest {}: {:8.3f} ms'.format(
+                label, timings[int(len(timings) * quantile)] * 1000))
+
+
+def legacy_item_dict(item):
+    from flask import url_for
+    return {
+        'id': item.id,
+        'title': item.title,
+        'description': item.description,
+        'price': item.price,
+        'category_id': item.category_id,
+        '_links': {
+            'self': url_for('api.get_item', id=item.id),
+            'category': url_for('api.get_category', id=item.category_id)
+        }
+    }
+
+
+def bench_serialize(args):
+    from flask import jsonify
+    from app import create_app, db
+    from app.catalog import seed_catalog
+    from app.models import Item
+    from app.serializers import json_response, orjson
+    from config import Config
+
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = 'sqlite://'
+        SEARCH_BACKEND = 'none'
+        RESPONSE_CACHE = False
+
+    app = create_app(BenchConfig)
+    with app.app_context():
+        db.create_all()
+        seed_catalog(args.items, 10, batch_size=5000)
+        items = Item.query.all()
+        with app.test_request_context('/api/items'):
+            for label, serialize in (
+                    ('url_for + jsonify', lambda: jsonify(
+                        {'items': [legacy_item_dict(item) for item in items]})),
+                    ('url templates + {}'.format(
+                        'orjson' if orjson else 'json'), lambda: json_response(
+                        {'items': [item.to_dict(to_collection=True, photo='none')
+                                   for item in items]}))):
+                serialize()
+                start = time.perf_counter()
+                for i in range(args.rounds):
+                    serialize()
+                elapsed = time.perf_counter() - start
+                print('{:24} {:8.2f} us/item'.format(
+                    label, elapsed / (args.rounds * len(items)) * 1e6))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='CMS micro benchmarks')
+    commands = parser.add_subparsers(dest='command', required=True)
+    thumbnails = commands.add_parser(
+        'thumbnails', help='thumbnail generation throughput')
+    thumbnails.add_argument('--images', type=int, default=20)
+    thumbnails.add_argument('--resolution', default='4000x3000')
+    thumbnails.add_argument('--sizes', default='500,120')
+    thumbnails.set_defaults(func=bench_thumbnails)
+    suggest = commands.add_parser(
+        'suggest', help='autocomplete latency without Elasticsearch')
+    suggest.add_argument('--items', type=int, default=50000)
+    suggest.add_argument('--queries', type=int, default=2000)
+    suggest.add_argument('--write-every', type=int, default=10,
+                         help='commit an item edit every N queries (0: none)')
+    suggest.set_defaults(func=bench_suggest)
+    serialize = commands.add_parser(
+        'serialize', help='per-item cost of API collection serialization')
+    serialize.add_argument('--items', type=int, default=5000)
+    serialize.add_argument('--rounds', type=int, default=5)
+    serialize.set_defaults(func=bench_serialize)
+    args = parser.parse_args()
+    args.func(args)
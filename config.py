@@ -17,5 +17,57 @@ class Config(object):
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
     ADMINS = ['your-email@example.com']
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND') or 'auto'
+    SEARCH_TEXT_CONFIG = os.environ.get('SEARCH_TEXT_CONFIG') or 'english'
+    SUGGEST_INDEX_TTL = 60
+    SEARCH_BULK_CHUNK_SIZE = int(os.environ.get('SEARCH_BULK_CHUNK_SIZE') or 500)
+    SEARCH_BULK_RETRIES = 3
+    SEARCH_INDEX_SHARDS = int(os.environ.get('SEARCH_INDEX_SHARDS') or 1)
+    SEARCH_INDEX_REPLICAS = int(os.environ.get('SEARCH_INDEX_REPLICAS') or 1)
+    SEARCH_INDEXER_THREAD = os.environ.get('SEARCH_INDEXER_THREAD', '1') != '0'
+    SEARCH_INDEXER_INTERVAL = 5
+    SEARCH_OUTBOX_BACKOFF = 1
+    SEARCH_OUTBOX_MAX_BACKOFF = 300
+    SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL') or 10)
     ITEMS_PER_PAGE = 10
-    USERS_PER_PAGE = 10
\ No newline at end of file
+    USERS_PER_PAGE = 10
+    PHOTO_STORAGE = os.environ.get('PHOTO_STORAGE') or 'filesystem'
+    PHOTO_ROOT = os.environ.get('PHOTO_ROOT') or imagedir
+    PHOTO_URL_PREFIX = os.environ.get('PHOTO_URL_PREFIX')
+    S3_BUCKET = os.environ.get('S3_BUCKET')
+    S3_PREFIX = os.environ.get('S3_PREFIX') or ''
+    S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL')
+    S3_REGION = os.environ.get('S3_REGION')
+    S3_URL_EXPIRES = int(os.environ.get('S3_URL_EXPIRES') or 3600)
+    S3_HEAD_CACHE_TTL = int(os.environ.get('S3_HEAD_CACHE_TTL') or 30)
+    S3_HEAD_MISS_TTL = int(os.environ.get('S3_HEAD_MISS_TTL') or 5)
+    THUMBNAIL_SIZES = [500, 240, 120]
+    THUMBNAIL_FORMATS = {
+        'WEBP': {'quality': 80, 'method': 4},
+        'JPEG': {'quality': 85, 'optimize': True, 'progressive': True}
+    }
+    THUMBNAIL_WORKERS = int(os.environ.get('THUMBNAIL_WORKERS') or 2)
+    THUMBNAIL_RETRIES = 3
+    THUMBNAIL_RETRY_BACKOFF = 0.5
+    CACHE_CONTROL = {
+        'main.show_categories': 'public, max-age=60',
+        'main.show_category': 'public, max-age=60',
+        'main.show_item': 'public, max-age=300',
+        'api.get_categories': 'public, max-age=60',
+        'api.get_category': 'public, max-age=60',
+        'api.get_items': 'public, max-age=60',
+        'api.get_item': 'public, max-age=300',
+        'api.suggest': 'public, max-age=60'
+    }
+    RESPONSE_CACHE = os.environ.get('RESPONSE_CACHE', '1') != '0'
+    RESPONSE_CACHE_SIZE = 1024
+    RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL') or 300)
+    REDIS_URL = os.environ.get('REDIS_URL')
+    ITEM_IMPORT_BATCH_SIZE = 1000
+    BATCH_UPDATE_LIMIT = 5000
+    TOKEN_CACHE_SIZE = 4096
+    TOKEN_CACHE_TTL = int(os.environ.get('TOKEN_CACHE_TTL') or 60)
+    API_TOKEN_MODE = os.environ.get('API_TOKEN_MODE') or 'database'
+    API_TOKEN_LIFETIME = int(os.environ.get('API_TOKEN_LIFETIME') or 3600)
+    THUMBNAIL_CACHE_BYTES = int(os.environ.get('THUMBNAIL_CACHE_BYTES') or
+                                32 * 1024 * 1024)
\ No newline at end of file
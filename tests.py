@@ -1,13 +1,36 @@
 #!/usr/bin/env python
+import base64
+import hashlib
+import io
+import json
+import jwt
+import os
+import tempfile
+import time
 import unittest
-from app import create_app, db
-from app.models import User, Item, Category
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from elasticsearch import Elasticsearch
+from flask import url_for
+from PIL import Image
+from app import cli, create_app, db
+from app.cache import response_cache
+from app.models import User, Item, Category, SearchOutbox, release_photo
+from app.catalog import load_file, seed_catalog
+from app.serializers import fast_url_for, json_response, stream_json_array
+from app.storage import FileSystemStorage, S3Storage
+from app.search import ElasticsearchBackend, prefix_index
+from app.utils import ThumbnailPayloadCache, ThumbnailQueue, delete_photo, \
+    generate_thumbnails, get_picture, get_thumbnail, make_thumbnails, \
+    store_photo, thumbnail_key, thumbnail_queue
 from config import Config
 
 
 class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    THUMBNAIL_WORKERS = 0
+    SEARCH_INDEXER_THREAD = False
 
 
 class UserModelCase(unittest.TestCase):
@@ -40,5 +63,1259 @@ class UserModelCase(unittest.TestCase):
         self.assertTrue(item2 in category.get_items().all())
 
 
+class APICase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_cursor_pagination(self):
+        category = Category(name='TEST CATEGORY NAME')
+        db.session.add(category)
+        db.session.commit()
+        for i in range(25):
+            db.session.add(Item(title='ITEM {}'.format(i),
+                                price=float(i % 7) if i % 5 else None,
+                                category_id=category.id))
+        db.session.commit()
+        seen = []
+        pages = []
+
+        def record_page(conn, cursor, statement, parameters, *args):
+            if statement.startswith('SELECT item.') and 'LIMIT' in statement:
+                pages.append((statement, parameters))
+
+        url = '/api/items?after=&sort=price&per_page=3&total=1'
+        db.event.listen(db.engine, 'before_cursor_execute', record_page)
+        try:
+            while url:
+                data = self.client.get(url).get_json()
+                self.assertEqual(data['_meta']['total_items'], 25)
+                seen.extend((item['price'] is None, item['price'] or 0,
+                             item['id']) for item in data['items'])
+                url = data['_links']['next']
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', record_page)
+        self.assertEqual(len(seen), 25)
+        self.assertEqual(seen, sorted(seen))
+        # Each page, in either phase, is an index range scan without a sort.
+        for statement, parameters in pages:
+            plan = ' '.join(row[-1] for row in db.session.connection().execute(
+                'EXPLAIN QUERY PLAN ' + statement, parameters))
+            self.assertTrue(plan.startswith('SEARCH'), plan)
+            self.assertNotIn('TEMP B-TREE', plan)
+        response = self.client.get('/api/items?after=garbage')
+        self.assertEqual(response.status_code, 400)
+
+    def test_categories_page_query_count(self):
+        for i in range(20):
+            category = Category(name='CATEGORY {}'.format(i))
+            db.session.add(category)
+            db.session.flush()
+            for j in range(i % 4):
+                db.session.add(Item(title='ITEM {} {}'.format(i, j), price=1.0,
+                                    category_id=category.id))
+        db.session.commit()
+        db.session.remove()
+        statements = []
+
+        def count_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        db.event.listen(db.engine, 'before_cursor_execute', count_statement)
+        try:
+            data = self.client.get('/api/categories?per_page=20').get_json()
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', count_statement)
+        self.assertEqual(len(data['items']), 20)
+        self.assertEqual([c['items_count'] for c in data['items']],
+                         [i % 4 for i in range(20)])
+        self.assertLessEqual(len(statements), 3)
+
+    def test_response_cache(self):
+        category = Category(name='TEST CATEGORY NAME')
+        db.session.add(category)
+        db.session.commit()
+        statements = []
+
+        def count_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        for url in ('/api/categories', '/catalog'):
+            first = self.client.get(url)
+            db.event.listen(db.engine, 'before_cursor_execute', count_statement)
+            try:
+                second = self.client.get(url)
+            finally:
+                db.event.remove(db.engine, 'before_cursor_execute',
+                                count_statement)
+            self.assertEqual(second.get_data(), first.get_data())
+            self.assertEqual(second.headers['ETag'], first.headers['ETag'])
+            self.assertEqual(statements, [])
+        category.name = 'RENAMED CATEGORY'
+        db.session.commit()
+        self.assertNotEqual(self.client.get('/catalog').headers['ETag'],
+                            first.headers['ETag'])
+        data = self.client.get('/api/categories').get_json()
+        self.assertEqual(data['items'][0]['name'], 'RENAMED CATEGORY')
+
+    def test_conditional_get(self):
+        category = Category(name='TEST CATEGORY NAME')
+        db.session.add(category)
+        db.session.commit()
+        item = Item(title='ITEM', price=1.0, category_id=category.id)
+        db.session.add(item)
+        db.session.commit()
+        for url in ('/api/items/{}'.format(item.id), '/api/categories',
+                    '/item/{}'.format(item.id)):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('max-age', response.headers['Cache-Control'])
+            etag = response.headers['ETag']
+            response = self.client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.headers['ETag'], etag)
+            item.price += 1
+            category.description = str(item.price)
+            db.session.commit()
+            response = self.client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_cached_responses_follow_thumbnails(self):
+        with tempfile.TemporaryDirectory() as root:
+            self.app.storage = FileSystemStorage(root, url_prefix='/photos/')
+            with tempfile.TemporaryFile() as f:
+                Image.new('RGB', (300, 200), 'red').save(f, format='PNG')
+                f.seek(0)
+                self.app.storage.save(f, 'photo.png')
+            category = Category(name='TEST CATEGORY NAME')
+            db.session.add(category)
+            db.session.commit()
+            db.session.add(Item(title='ITEM', price=1.0, photo_id='photo.png',
+                                category_id=category.id))
+            db.session.commit()
+            first = self.client.get('/api/items/1')
+            self.assertIsNone(first.get_json()['photo_data'])
+            self.assertIn(b'placeholder.svg', self.client.get('/item/1').data)
+            thumbnail_queue.submit('photo.png', self.app.storage)
+            second = self.client.get('/api/items/1')
+            self.assertIsNotNone(second.get_json()['photo_data'])
+            self.assertNotEqual(second.headers['ETag'], first.headers['ETag'])
+            self.assertNotIn(b'placeholder.svg', self.client.get('/item/1').data)
+
+    def test_changes_flushed_before_commit_invalidate(self):
+        category = Category(name='TEST CATEGORY NAME')
+        db.session.add(category)
+        db.session.commit()
+        item = Item(title='ITEM', price=1.0, category_id=category.id)
+        user = User(username='susan')
+        db.session.add_all([item, user])
+        db.session.commit()
+        self.assertEqual(self.client.get('/api/items/1').get_json()['price'], 1.0)
+        generation = response_cache.generations(('user',))
+        item.price = 99.0
+        user.permission = 'manager'
+        db.session.flush()
+        db.session.commit()
+        self.assertEqual(self.client.get('/api/items/1').get_json()['price'],
+                         99.0)
+        self.assertNotEqual(response_cache.generations(('user',)), generation)
+
+    def test_sparse_fieldsets(self):
+        category = Category(name='TEST CATEGORY NAME')
+        db.session.add(category)
+        db.session.commit()
+        for i in range(3):
+            db.session.add(Item(title='ITEM {}'.format(i), description='LONG',
+                                price=float(i), category_id=category.id))
+        db.session.commit()
+        statements = []
+
+        def count_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        db.event.listen(db.engine, 'before_cursor_execute', count_statement)
+        try:
+            data = self.client.get(
+                '/api/items?fields=id,title,price&per_page=2').get_json()
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', count_statement)
+        self.assertEqual(data['items'][0], {'id': 1, 'title': 'ITEM 0',
+                                            'price': 0.0})
+        self.assertIn('fields=id%2Cprice%2Ctitle', data['_links']['next'])
+        self.assertFalse([s for s in statements if 'item.description' in s])
+        data = self.client.get('/api/items/2?fields=price&embed=category') \
+            .get_json()
+        self.assertEqual(data['price'], 1.0)
+        self.assertEqual(data['_embedded']['category']['name'],
+                         'TEST CATEGORY NAME')
+        data = self.client.get('/api/categories?fields=name,items_count') \
+            .get_json()
+        self.assertEqual(data['items'], [{'name': 'TEST CATEGORY NAME',
+                                          'items_count': 3}])
+        self.assertEqual(self.client.get('/api/items?fields=secret')
+                         .status_code, 400)
+        self.assertEqual(self.client.get('/api/categories/1?embed=items')
+                         .status_code, 400)
+
+    def test_sparse_fieldsets_skip_unrequested_work(self):
+        checks = []
+
+        class CountingStorage(FileSystemStorage):
+            def exists(self, key, cached=True):
+                checks.append(key)
+                return False
+
+        with tempfile.TemporaryDirectory() as root:
+            self.app.storage = CountingStorage(root, url_prefix='/photos/')
+            category = Category(name='TEST CATEGORY NAME', photo_id='c.png')
+            db.session.add(category)
+            db.session.commit()
+            db.session.add_all([Item(title='ITEM {}'.format(i),
+                                     photo_id='i.png', category_id=category.id)
+                                for i in range(3)])
+            db.session.commit()
+            statements = []
+
+            def count_statement(conn, cursor, statement, *args):
+                statements.append(statement)
+
+            db.event.listen(db.engine, 'before_cursor_execute', count_statement)
+            try:
+                for url in ('/api/items?fields=id,title',
+                            '/api/items/1?fields=id',
+                            '/api/items?after=&photo=none',
+                            '/api/categories?fields=name',
+                            '/api/categories/1?fields=name'):
+                    self.assertEqual(self.client.get(url).status_code, 200)
+            finally:
+                db.event.remove(db.engine, 'before_cursor_execute',
+                                count_statement)
+            self.assertEqual(checks, [])
+            self.assertFalse([s for s in statements
+                              if 'count(item.id)' in s or
+                              'WHERE item.category_id' in s])
+            self.client.get('/api/categories?fields=items_count,photo')
+            self.assertTrue(checks)
+
+    def test_fast_url_for(self):
+        for script_root in ('', '/shop'):
+            with self.app.test_request_context(
+                    environ_base={'SCRIPT_NAME': script_root}):
+                for id in (1, 42):
+                    self.assertEqual(fast_url_for('api.get_item', id=id),
+                                     url_for('api.get_item', id=id))
+                self.assertEqual(fast_url_for('api.get_categories'),
+                                 url_for('api.get_categories'))
+        with self.app.test_request_context():
+            response = json_response({'b': [1.5, None], 'a': 'caf\xe9'}, 201)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.get_json(), {'a': 'caf\xe9', 'b': [1.5, None]})
+        self.assertEqual(b''.join(stream_json_array(iter(range(5)), 2)),
+                         b'[0,1,2,3,4]\n')
+
+    def test_token_identity_cache(self):
+        user = User(username='admin', email='admin@example.com',
+                    permission='admin')
+        user.set_password('secret')
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+        basic = {'Authorization': 'Basic ' + base64.b64encode(
+            b'admin:secret').decode('ascii')}
+        token = self.client.post('/api/tokens', headers=basic).get_json()['token']
+        headers = {'Authorization': 'Bearer ' + token}
+        self.assertEqual(self.client.get('/api/users', headers=headers)
+                         .status_code, 200)
+        self.client.post('/api/tokens', headers=basic)
+        db.session.remove()
+        statements = []
+
+        def count_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        db.event.listen(db.engine, 'before_cursor_execute', count_statement)
+        try:
+            self.assertEqual(self.client.get('/api/users', headers=headers)
+                             .status_code, 200)
+            self.assertEqual(self.client.post('/api/tokens', headers=basic)
+                             .get_json()['token'], token)
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', count_statement)
+        self.assertFalse([s for s in statements if 'user.token =' in s or
+                          'user.username =' in s])
+        user = User.query.get(user_id)
+        user.permission = 'customer'
+        db.session.commit()
+        self.assertEqual(self.client.get('/api/users', headers=headers)
+                         .status_code, 403)
+        self.assertEqual(self.client.delete('/api/tokens', headers=headers)
+                         .status_code, 204)
+        self.assertEqual(self.client.get('/api/users', headers=headers)
+                         .status_code, 401)
+
+    def test_signed_token_revoked_within_the_second(self):
+        user = User(username='admin', permission='admin')
+        db.session.add(user)
+        db.session.commit()
+        revoked_at = (datetime.utcnow() - timedelta(seconds=10)).replace(
+            microsecond=500000)
+        user.tokens_revoked_at = revoked_at
+        db.session.commit()
+        db.session.expire_all()
+        self.assertEqual(User.query.get(user.id).tokens_revoked_at, revoked_at)
+        issued = (revoked_at - datetime(1970, 1, 1)).total_seconds()
+
+        def token(iat):
+            return jwt.encode({'sub': str(user.id), 'name': 'admin',
+                               'perm': 'admin', 'iat': iat,
+                               'exp': time.time() + 60},
+                              self.app.config['SECRET_KEY'], algorithm='HS256')
+
+        self.assertIsNone(User.check_token(token(issued - 0.001)))
+        self.assertIsNone(User.check_token(token(issued)))
+        self.assertIsNotNone(User.check_token(token(issued + 0.001)))
+
+    def test_signed_tokens(self):
+        self.app.config['API_TOKEN_MODE'] = 'jwt'
+        user = User(username='admin', email='admin@example.com',
+                    permission='admin')
+        user.set_password('secret')
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+        basic = {'Authorization': 'Basic ' + base64.b64encode(
+            b'admin:secret').decode('ascii')}
+        token = self.client.post('/api/tokens', headers=basic).get_json()['token']
+        self.assertIsNone(User.query.get(user_id).token)
+        headers = {'Authorization': 'Bearer ' + token}
+        self.assertEqual(self.client.get('/api/users', headers=headers)
+                         .status_code, 200)
+        db.session.remove()
+        statements = []
+
+        def count_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        db.event.listen(db.engine, 'before_cursor_execute', count_statement)
+        try:
+            self.assertEqual(self.client.get('/api/users/{}'.format(user_id),
+                                             headers=headers).status_code, 200)
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', count_statement)
+        self.assertEqual(statements, [])
+        user = User.query.get(user_id)
+        user.permission = 'manager'
+        db.session.commit()
+        self.assertEqual(self.client.get('/api/users', headers=headers)
+                         .status_code, 401)
+        token = self.client.post('/api/tokens', headers=basic).get_json()['token']
+        headers = {'Authorization': 'Bearer ' + token}
+        self.assertEqual(self.client.get('/api/users', headers=headers)
+                         .status_code, 403)
+        self.assertEqual(self.client.delete('/api/tokens', headers=headers)
+                         .status_code, 204)
+        self.assertEqual(self.client.get('/api/users', headers=headers)
+                         .status_code, 401)
+
+    def test_session_user_loader(self):
+        user = User(username='manager', email='manager@example.com',
+                    permission='manager')
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(user_id)
+        self.client.get('/catalog')
+        statements = []
+
+        def count_statement(conn, cursor, statement, *args):
+            if 'FROM user' in statement:
+                statements.append(statement)
+
+        db.event.listen(db.engine, 'before_cursor_execute', count_statement)
+        try:
+            self.assertEqual(self.client.get('/catalog').status_code, 200)
+            self.assertEqual(statements, [])
+            user = User.query.get(user_id)
+            user.permission = 'admin'
+            db.session.commit()
+            db.session.remove()
+            self.client.get('/catalog')
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', count_statement)
+        self.assertEqual(len(statements), 1)
+        self.assertNotIn('password_hash', statements[0])
+
+
+class DatabaseSearchCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        fruit = Category(name='FRUIT')
+        baking = Category(name='BAKING')
+        db.session.add_all([fruit, baking])
+        db.session.commit()
+        self.items = [
+            Item(title='red apple', price=10.0, category_id=fruit.id),
+            Item(title='green apple', price=60.0, category_id=fruit.id),
+            Item(title='banana', description='not an apple', price=20.0,
+                 category_id=fruit.id),
+            Item(title='apple flour', price=75.0, category_id=baking.id)]
+        db.session.add_all(self.items)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def manager_headers(self):
+        user = User(username='manager', email='manager@example.com',
+                    permission='manager')
+        db.session.add(user)
+        token = user.get_token()
+        db.session.commit()
+        return {'Authorization': 'Bearer ' + token}
+
+    def search(self, expression, **filters):
+        results = Item.search(expression, 1, 10, filters)
+        return sorted(hit['title'] for hit in results['hits']), results['total']
+
+    def test_search_follows_commits(self):
+        self.assertEqual(self.search('green'), (['green apple'], 1))
+        self.assertEqual(self.search('(red*'), (['red apple'], 1))
+        self.items[2].title = 'apple pie'
+        db.session.delete(self.items[0])
+        db.session.commit()
+        self.assertEqual(self.search('pie'), (['apple pie'], 1))
+        self.assertEqual(self.search('red'), ([], 0))
+        db.session.execute('DELETE FROM item_search')
+        indexed, table, elapsed = Item.reindex(chunk_size=2)
+        self.assertEqual(indexed, 3)
+        self.assertEqual(self.search('pie'), (['apple pie'], 1))
+
+    def test_filters_and_facets(self):
+        self.assertEqual(self.search('apple', category_id=[1], price=(None, 50)),
+                         (['banana', 'red apple'], 2))
+        results = Item.search('apple', 1, 10, {'category_id': [1]})
+        self.assertEqual(results['facets']['category_id'],
+                         [{'value': 1, 'count': 3}, {'value': 2, 'count': 1}])
+        self.assertEqual(results['facets']['price'], [
+            {'from': 0, 'to': 50, 'count': 2}, {'from': 50, 'to': 100, 'count': 1}])
+
+    def test_search_results_are_cached(self):
+        statements = []
+
+        def count_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        self.assertEqual(self.search('apple', price=(None, 50)),
+                         (['banana', 'red apple'], 2))
+        db.event.listen(db.engine, 'before_cursor_execute', count_statement)
+        try:
+            self.assertEqual(self.search(' APPLE ', price=(None, 50)),
+                             (['banana', 'red apple'], 2))
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', count_statement)
+        self.assertEqual(statements, [])
+        self.items[1].price = 5.0
+        db.session.commit()
+        self.assertEqual(self.search('apple', price=(None, 50)),
+                         (['banana', 'green apple', 'red apple'], 3))
+
+    def test_suggest(self):
+        self.assertEqual([s['title'] for s in Item.suggest('AP')],
+                         ['apple flour', 'green apple', 'red apple'])
+        self.assertEqual(Item.suggest('red ap'), [{'id': 1, 'title': 'red apple'}])
+        self.assertEqual(Item.suggest('  '), [])
+        self.items[1].title = 'grape'
+        db.session.commit()
+        self.assertEqual([s['title'] for s in Item.suggest('gr')], ['grape'])
+        data = self.app.test_client().get('/api/suggest?q=ban&limit=5').get_json()
+        self.assertEqual(data['suggestions'], [{'id': 3, 'title': 'banana'}])
+
+    def test_suggest_index_is_patched_not_rebuilt(self):
+        self.assertEqual(Item.suggest('red ap'), [{'id': 1, 'title': 'red apple'}])
+        statements = []
+
+        def count_statement(conn, cursor, statement, *args):
+            if 'FROM item' in statement:
+                statements.append(statement)
+
+        client = self.app.test_client()
+        headers = self.manager_headers()
+        db.event.listen(db.engine, 'before_cursor_execute', count_statement)
+        try:
+            self.items[0].price = 11.0
+            db.session.commit()
+            self.assertEqual(Item.suggest('red ap'),
+                             [{'id': 1, 'title': 'red apple'}])
+            client.patch('/api/items', headers=headers, json=[
+                {'id': 2, 'changes': {'title': 'ruby apple'}}])
+            db.session.delete(self.items[3])
+            db.session.commit()
+            self.assertEqual([s['title'] for s in Item.suggest('ap')],
+                             ['red apple', 'ruby apple'])
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', count_statement)
+        self.assertFalse([s for s in statements if 'item.title IS NOT' in s])
+        rebuilds = []
+        prefix_index.rebuild = lambda app, model: rebuilds.append(model)
+        try:
+            self.app.config['SUGGEST_INDEX_TTL'] = 0
+            self.items[2].title = 'plantain'
+            db.session.commit()
+            self.assertEqual(Item.suggest('pla'), [{'id': 3, 'title': 'plantain'}])
+            for _ in range(50):
+                if rebuilds:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(rebuilds, [Item])
+        finally:
+            del prefix_index.rebuild
+            prefix_index._building.clear()
+
+    def test_api_search(self):
+        client = self.app.test_client()
+        data = client.get('/api/search?q=apple&price_min=50&per_page=1').get_json()
+        self.assertEqual(data['_meta']['total_items'], 2)
+        self.assertEqual(len(data['items']), 1)
+        self.assertIn('price_min=50', data['_links']['next'])
+        self.assertEqual(client.get('/api/search').status_code, 400)
+        response = client.get('/search?q=apple&category_id=2')
+        self.assertIn(b'apple flour', response.get_data())
+        self.assertNotIn(b'green apple', response.get_data())
+        db.session.add(Item(title='golden apple', price=50.0, category_id=1))
+        db.session.commit()
+        for query, total in (('price_max=50', 3), ('price_below=50', 2),
+                             ('price_min=50&price_below=100', 3)):
+            self.assertEqual(client.get('/api/search?q=apple&' + query)
+                             .get_json()['_meta']['total_items'], total)
+        response = client.get('/search?q=apple')
+        self.assertIn(b'price_min=0&amp;price_below=50"', response.get_data())
+        self.assertNotIn(b'price_max', response.get_data())
+
+    def test_bulk_import_and_export(self):
+        self.app.config['ITEM_IMPORT_BATCH_SIZE'] = 2
+        client = self.app.test_client()
+        headers = self.manager_headers()
+        self.assertEqual(self.search('cherry'), ([], 0))
+        body = '\n'.join([
+            json.dumps({'title': 'cherry pie', 'price': 5, 'category_id': 2}),
+            '{not json',
+            json.dumps({'title': 'cherry', 'price': 'cheap', 'category_id': 1}),
+            json.dumps({'title': 'cherry jam', 'price': 3, 'category_id': 9}),
+            json.dumps({'title': 'wild cherry', 'price': 7, 'category_id': 1}),
+            json.dumps({'title': 'cherry', 'price': 1.5, 'category_id': 1})])
+        data = client.post('/api/items/bulk', data=body, headers=headers,
+                           content_type='application/x-ndjson').get_json()
+        self.assertEqual(data['created'], 3)
+        self.assertEqual([error['line'] for error in data['errors']], [2, 3, 4])
+        self.assertEqual(self.search('cherry')[1], 3)
+        csv_body = 'title,description,price,category_id\n' \
+            'plum,"sweet, dark",4.5,1\nbad plum,,,1\n'
+        data = client.post('/api/items/bulk', data=csv_body, headers=headers,
+                           content_type='text/csv').get_json()
+        self.assertEqual((data['created'], data['error_count']), (1, 1))
+        self.assertEqual(self.search('sweet'), (['plum'], 1))
+        response = client.get('/api/items/export', headers=headers)
+        rows = [json.loads(line) for line in response.get_data(as_text=True)
+                .splitlines()]
+        self.assertEqual(len(rows), 8)
+        self.assertEqual(rows[-1]['description'], 'sweet, dark')
+        response = client.get('/api/items/export?format=json', headers=headers)
+        self.assertEqual(response.get_json(), rows)
+        response = client.get('/api/items/export?format=csv&category_id=2',
+                              headers=headers)
+        self.assertEqual(response.get_data(as_text=True).splitlines()[1:],
+                         ['4,apple flour,,75.0,2,', '5,cherry pie,,5.0,2,'])
+
+    def test_parallel_load_splits_records(self):
+        body = {
+            False: '\n'.join(json.dumps({'title': 'berry {}'.format(i),
+                                         'price': i, 'category_id': 1})
+                             for i in range(5)) + '\n{not json\n',
+            True: 'title,description,price,category_id\n'
+                  'berry 0,"two\nlines",1,1\nberry 1,,2,1\n\nberry 2,,3,1\n'
+                  'berry 3,,,1\n'}
+        for csv_format, expected in ((False, (5, [6])), (True, (3, [7]))):
+            with tempfile.NamedTemporaryFile('w', suffix='.txt',
+                                             delete=False) as f:
+                f.write(body[csv_format])
+            try:
+                results = [load_file(f.name, csv_format, 2, part=part, parts=2)
+                           for part in range(2)]
+            finally:
+                os.remove(f.name)
+            self.assertTrue(all(result[0] for result in results))
+            self.assertEqual((sum(result[0] for result in results),
+                              [error['line'] for result in results
+                               for error in result[2]]), expected)
+        self.assertEqual(Item.query.filter_by(description='two\nlines').count(),
+                         1)
+
+    def test_seed_catalog(self):
+        inserts = []
+
+        def count_insert(conn, cursor, statement, *args):
+            if statement.startswith('INSERT INTO item '):
+                inserts.append(statement)
+
+        db.event.listen(db.engine, 'before_cursor_execute', count_insert)
+        try:
+            created, categories, photos, elapsed = seed_catalog(
+                30, 3, workers=1, batch_size=8, seed=1)
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', count_insert)
+        self.assertEqual((created, categories, photos), (30, 3, 0))
+        self.assertEqual(len(inserts), 4)
+        self.assertEqual(Item.query.get(34).title.split()[-1], '29')
+        self.assertEqual(Item.query.get(34).version, 1)
+        self.assertEqual(Item.query.count(), 34)
+        self.assertEqual(Category.query.count(), 5)
+        title = Item.query.order_by(Item.id.desc()).first().title
+        self.assertEqual(self.search(title), ([title], 1))
+
+    def test_batch_patch(self):
+        client = self.app.test_client()
+        headers = self.manager_headers()
+        self.assertEqual(client.get('/api/items/1').get_json()['price'], 10.0)
+        response = client.patch('/api/items', headers=headers, json=[
+            {'id': 1, 'version': 1, 'changes': {'price': 12.5}},
+            {'id': 2, 'changes': {'price': 61, 'title': 'apple flour'}},
+            {'id': 4, 'changes': {'title': 'rye flour', 'category_id': 1}}])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['updated'], [
+            {'id': 1, 'version': 2}, {'id': 2, 'version': 2},
+            {'id': 4, 'version': 2}])
+        self.assertEqual(client.get('/api/items/1').get_json()['price'], 12.5)
+        self.assertEqual(self.search('flour'), (['apple flour', 'rye flour'], 2))
+        self.assertEqual(self.search('rye', category_id=[1])[1], 1)
+        for updates, status in (
+                ([{'id': 1, 'version': 1, 'changes': {'price': 1}}], 409),
+                ([{'id': 99, 'changes': {'price': 1}}], 404),
+                ([{'id': 1, 'changes': {'title': 'banana'}}], 400),
+                ([{'id': 1, 'changes': {'category_id': 9}}], 400),
+                ([{'id': 1, 'changes': {'price': 'free'}}], 400),
+                ([{'id': 1, 'changes': {'photo_id': 'x'}}], 400)):
+            self.assertEqual(client.patch('/api/items', headers=headers,
+                                          json=updates).status_code, status)
+        self.assertEqual(Item.query.get(1).version, 2)
+        response = client.patch('/api/categories', headers=headers, json=[
+            {'id': 1, 'changes': {'name': 'PRODUCE'}}])
+        self.assertEqual(response.get_json()['updated'], [{'id': 1, 'version': 2}])
+        self.assertEqual(client.get('/api/categories/1').get_json()['name'],
+                         'PRODUCE')
+
+
+class FakeIndices(object):
+    def __init__(self, indices):
+        self.indices = set(indices)
+        self.aliases = {}
+        self.actions = []
+
+    def create(self, index, body):
+        self.indices.add(index)
+        for alias in body.get('aliases', {}):
+            self.aliases[alias] = index
+
+    def put_settings(self, index, body):
+        pass
+
+    def refresh(self, index):
+        pass
+
+    def exists(self, index):
+        return index in self.indices
+
+    def exists_alias(self, name):
+        return name in self.aliases
+
+    def get_alias(self, name):
+        return {self.aliases[name]: {}}
+
+    def update_aliases(self, body):
+        self.actions.append(body['actions'])
+        for action in body['actions']:
+            if 'remove_index' in action:
+                self.indices.remove(action['remove_index']['index'])
+            elif 'remove' in action:
+                self.delete_alias(**action['remove'])
+            elif 'add' in action:
+                self.aliases[action['add']['alias']] = action['add']['index']
+
+    def delete_alias(self, index, name=None, alias=None):
+        if self.aliases.get(name or alias) == index:
+            del self.aliases[name or alias]
+
+    def delete(self, index):
+        self.indices.remove(index)
+
+
+class SearchIndexCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.requests = []
+        self.refreshes = []
+        self.failing = set()
+        self.app.elasticsearch = Elasticsearch()
+        self.app.elasticsearch.bulk = self.bulk
+        self.app.elasticsearch.indices = FakeIndices({'item'})
+        self.app.search_backend = ElasticsearchBackend()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def bulk(self, body, *args, **kwargs):
+        lines = [json.loads(line) for line in body.splitlines()]
+        self.requests.append(lines)
+        self.refreshes.append((kwargs.get('refresh'),
+                               response_cache.generations(('search:item',))))
+        items = []
+        for line in lines:
+            if 'index' in line or 'delete' in line:
+                op_type, meta = next(iter(line.items()))
+                if meta['_id'] in self.failing:
+                    items.append({op_type: dict(meta, status=503,
+                                                error='unavailable')})
+                else:
+                    items.append({op_type: dict(meta, status=200)})
+        return {'errors': bool(self.failing), 'items': items}
+
+    def test_outbox_is_coalesced_and_drained_in_one_request(self):
+        category = Category(name='TEST CATEGORY NAME')
+        db.session.add(category)
+        db.session.commit()
+        items = [Item(title='ITEM {}'.format(i), category_id=category.id)
+                 for i in range(5)]
+        db.session.add_all(items)
+        db.session.commit()
+        items[1].title = 'RENAMED'
+        db.session.commit()
+        db.session.delete(items[0])
+        db.session.commit()
+        self.assertEqual(self.requests, [])
+        self.assertEqual(SearchOutbox.stats()['pending'], 7)
+        self.assertEqual(SearchOutbox.drain(), 7)
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(len(self.requests[0]), 4 * 2 + 1)
+        self.assertIn('RENAMED', [line.get('title') for line in self.requests[0]])
+        self.assertIn({'delete': {'_index': 'item', '_id': 1}}, self.requests[0])
+        self.assertEqual(SearchOutbox.stats()['pending'], 0)
+
+    def test_drain_invalidates_search_results_once_searchable(self):
+        category = Category(name='TEST CATEGORY NAME')
+        db.session.add(category)
+        db.session.commit()
+        db.session.add(Item(title='ITEM', category_id=category.id))
+        db.session.commit()
+        generation = response_cache.generations(('search:item',))
+        self.assertEqual(SearchOutbox.drain(), 1)
+        self.assertEqual(self.refreshes, [('wait_for', generation)])
+        self.assertNotEqual(response_cache.generations(('search:item',)),
+                            generation)
+
+    def test_search_results_expire_quickly_without_redis(self):
+        self.app.search_backend.search = lambda *args: {
+            'hits': [], 'total': 0, 'facets': {}}
+        Item.search('item', 1, 10)
+        (expires, _), = response_cache._entries.values()
+        self.assertLessEqual(expires, time.time() +
+                             self.app.config['SEARCH_CACHE_TTL'])
+
+    def test_outbox_retries_failed_documents(self):
+        category = Category(name='TEST CATEGORY NAME')
+        db.session.add(category)
+        db.session.commit()
+        db.session.add_all([Item(title='ITEM {}'.format(i), category_id=category.id)
+                            for i in range(2)])
+        db.session.commit()
+        self.failing = {2}
+        self.assertEqual(SearchOutbox.drain(), 2)
+        entry = SearchOutbox.query.one()
+        self.assertEqual((entry.object_id, entry.attempts), (2, 1))
+        self.assertGreater(entry.available_at, datetime.utcnow())
+        self.assertEqual(SearchOutbox.drain(), 0)
+        self.failing = set()
+        entry.available_at = datetime.utcnow()
+        db.session.commit()
+        self.assertEqual(SearchOutbox.drain(), 1)
+        self.assertEqual(SearchOutbox.stats(), {'pending': 0, 'retrying': 0,
+                                                'lag_seconds': 0.0})
+
+    def test_faceted_search_is_one_request(self):
+        bodies = []
+
+        def search(index, body):
+            bodies.append(body)
+            return {
+                'hits': {'total': {'value': 1}, 'hits': [
+                    {'_id': '7', '_source': {'title': 'ITEM', 'price': 12.5}}]},
+                'aggregations': {
+                    'category_id': {'buckets': {'buckets': [
+                        {'key': 1, 'doc_count': 1}]}},
+                    'price': {'buckets': {'buckets': [
+                        {'key': 0.0, 'doc_count': 1}]}}}}
+
+        self.app.elasticsearch.search = search
+        results = Item.search('item', 1, 10, {'category_id': [1],
+                                              'price': (10, None)})
+        self.assertEqual(len(bodies), 1)
+        self.assertEqual(bodies[0]['post_filter']['bool']['filter'], [
+            {'terms': {'category_id': [1]}}, {'range': {'price': {'gte': 10}}}])
+        self.assertEqual(bodies[0]['aggs']['category_id']['filter']['bool']['filter'],
+                         [{'range': {'price': {'gte': 10}}}])
+        self.assertEqual(results['hits'], [{'id': 7, 'title': 'ITEM', 'price': 12.5}])
+        self.assertEqual(results['facets']['price'],
+                         [{'from': 0.0, 'to': 50.0, 'count': 1}])
+        response = self.app.test_client().get(
+            '/api/search?q=item&price_below=50&photo=none')
+        self.assertEqual(bodies[-1]['post_filter']['bool']['filter'],
+                         [{'range': {'price': {'lt': 50}}}])
+        self.assertEqual(response.get_json()['items'], [{
+            'id': 7, 'title': 'ITEM', 'description': None, 'price': 12.5,
+            'category_id': None,
+            '_links': {'self': '/api/items/7', 'category': None}}])
+
+    def test_reindex_fills_new_index_and_swaps_alias(self):
+        indices = self.app.elasticsearch.indices = FakeIndices({'item'})
+        category = Category(name='TEST CATEGORY NAME')
+        db.session.add(category)
+        db.session.commit()
+        db.session.add_all([Item(title='ITEM {}'.format(i), category_id=category.id)
+                            for i in range(25)])
+        db.session.commit()
+        self.requests = []
+        indexed, index, elapsed = Item.reindex(chunk_size=10)
+        self.assertEqual(indexed, 25)
+        self.assertEqual([len(lines) for lines in self.requests], [14, 14, 14, 8])
+        self.assertEqual({line['index']['_index'] for lines in self.requests
+                          for line in lines if 'index' in line}, {index})
+        self.assertEqual(indices.actions[-1], [
+            {'remove_index': {'index': 'item'}},
+            {'add': {'index': index, 'alias': 'item'}},
+            {'remove': {'index': index, 'alias': 'item-rebuild'}}])
+        indexed, new_index, elapsed = Item.reindex(chunk_size=10)
+        self.assertEqual(indices.actions[-1], [
+            {'remove': {'index': index, 'alias': 'item'}},
+            {'add': {'index': new_index, 'alias': 'item'}},
+            {'remove': {'index': new_index, 'alias': 'item-rebuild'}}])
+        self.assertEqual(indices.indices, {new_index})
+        self.assertEqual(indices.aliases, {'item': new_index})
+        self.failing = {1}
+        with self.assertRaises(RuntimeError):
+            Item.reindex(chunk_size=10)
+        self.assertEqual(indices.aliases, {'item': new_index})
+
+    def test_deletes_reach_an_index_being_rebuilt(self):
+        indices = self.app.elasticsearch.indices
+        category = Category(name='TEST CATEGORY NAME')
+        db.session.add(category)
+        db.session.commit()
+        items = [Item(title='ITEM {}'.format(i), category_id=category.id)
+                 for i in range(2)]
+        db.session.add_all(items)
+        db.session.commit()
+        SearchOutbox.drain()
+        indices.create('item-20990101000000000000',
+                       {'aliases': {'item-rebuild': {}}})
+        self.requests = []
+        db.session.delete(items[0])
+        items[1].title = 'RENAMED'
+        db.session.commit()
+        self.assertEqual(SearchOutbox.drain(), 2)
+        self.assertEqual([[line for line in lines if 'delete' in line]
+                          for lines in self.requests], [
+            [{'delete': {'_index': 'item', '_id': 1}}],
+            [{'delete': {'_index': 'item-rebuild', '_id': 1}}]])
+        self.assertEqual(len(self.requests[1]), 1)
+
+
+class ThumbnailPayloadCacheCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.storage = FileSystemStorage(self.dir.name)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write(self, key, data):
+        with tempfile.TemporaryFile() as f:
+            f.write(data)
+            f.seek(0)
+            self.storage.save(f, key)
+
+    def test_payload_is_cached_and_evicted_by_size(self):
+        cache = ThumbnailPayloadCache(max_bytes=16)
+        self.write('thumbnails/a.jpg', b'123456789')
+        self.write('thumbnails/b.jpg', b'abcdefghi')
+        self.assertEqual(cache.get(self.storage, 'thumbnails/a.jpg'), 'MTIzNDU2Nzg5')
+        self.assertEqual(cache.size, 12)
+        self.assertEqual(cache.get(self.storage, 'thumbnails/b.jpg'), 'YWJjZGVmZ2hp')
+        self.assertEqual(cache.size, 12)
+        self.assertIsNone(cache.get(self.storage, 'thumbnails/missing.jpg'))
+
+    def test_payload_changes_with_mtime(self):
+        cache = ThumbnailPayloadCache()
+        self.write('a.jpg', b'old')
+        self.assertEqual(cache.get(self.storage, 'a.jpg'), 'b2xk')
+        self.write('a.jpg', b'new')
+        path = self.storage.path('a.jpg')
+        os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 10 ** 9))
+        self.assertEqual(cache.get(self.storage, 'a.jpg'), 'bmV3')
+
+
+class FlakyStorage(FileSystemStorage):
+    def __init__(self, root, failures=0):
+        super(FlakyStorage, self).__init__(root, url_prefix='/photos/')
+        self.failures = failures
+        self.attempts = 0
+
+    def local_path(self, key):
+        self.attempts += 1
+        if self.attempts <= self.failures:
+            raise IOError('storage is unavailable')
+        return super(FlakyStorage, self).local_path(key)
+
+
+class ThumbnailCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.dir = tempfile.TemporaryDirectory()
+        self.app.storage = self.storage = FlakyStorage(self.dir.name)
+        self.context = self.app.test_request_context()
+        self.context.push()
+
+    def tearDown(self):
+        self.context.pop()
+        self.dir.cleanup()
+
+    def write_image(self, key, img, img_format):
+        with tempfile.TemporaryFile() as f:
+            img.save(f, format=img_format)
+            f.seek(0)
+            self.storage.save(f, key)
+
+    def make_queue(self, workers=0, retries=2, backoff=0.0):
+        queue = ThumbnailQueue()
+        queue.sizes, queue.formats = [240, 120], {}
+        queue.workers, queue.retries, queue.backoff = workers, retries, backoff
+        queue.logger = self.app.logger
+        return queue
+
+    def test_generate_thumbnails_retries_with_backoff(self):
+        self.write_image('photo.png', Image.new('RGB', (300, 200)), 'PNG')
+        self.storage.failures = 2
+        self.assertTrue(generate_thumbnails('photo.png', self.storage, [120],
+                                            retries=2, backoff=0))
+        self.assertEqual(self.storage.attempts, 3)
+        self.assertTrue(self.storage.exists(thumbnail_key('photo.png', 120)))
+        self.storage.failures, self.storage.attempts = 3, 0
+        with self.assertRaises(IOError):
+            generate_thumbnails('photo.png', self.storage, [120], retries=1,
+                                backoff=0)
+        self.assertEqual(self.storage.attempts, 2)
+        self.assertFalse(generate_thumbnails('missing.png', self.storage, [120]))
+
+    def test_queue_falls_back_to_in_process_generation(self):
+        self.write_image('photo.png', Image.new('RGB', (300, 200)), 'PNG')
+        queue = self.make_queue(workers=2)
+
+        def unavailable():
+            raise RuntimeError('cannot schedule new futures after shutdown')
+
+        queue._get_executor = unavailable
+        queue.submit('photo.png', self.storage)
+        self.assertTrue(self.storage.exists(thumbnail_key('photo.png', 240)))
+
+    def test_retries_do_not_block_the_request(self):
+        self.write_image('photo.png', Image.new('RGB', (300, 200)), 'PNG')
+        self.storage.failures = 1
+        queue = self.make_queue(backoff=0.2)
+        start = time.time()
+        queue.submit('photo.png', self.storage)
+        self.assertLess(time.time() - start, 0.2)
+        key = thumbnail_key('photo.png', 120)
+        self.assertEqual(get_thumbnail('photo.png', 120), '/static/placeholder.svg')
+        self.assertEqual(get_picture('photo.png', 120)['src'],
+                         '/static/placeholder.svg')
+        for _ in range(50):
+            if self.storage.exists(key):
+                break
+            time.sleep(0.05)
+        self.assertEqual(self.storage.attempts, 2)
+        self.assertEqual(get_thumbnail('photo.png', 120), '/photos/' + key)
+
+    def test_make_thumbnails_from_large_images_in_any_mode(self):
+        palette = Image.new('RGB', (2400, 1800), (200, 30, 30)).quantize(16)
+        transparent = Image.new('RGBA', (2400, 1800), (30, 200, 30, 128))
+        for key, img, img_format in (
+                ('palette.png', palette, 'PNG'), ('palette.gif', palette, 'GIF'),
+                ('bilevel.png', palette.convert('1'), 'PNG'),
+                ('deep.png', Image.new('I;16', (2400, 1800), 4000), 'PNG'),
+                ('alpha.png', transparent, 'PNG')):
+            self.write_image(key, img, img_format)
+            with self.storage.local_path(key) as filepath:
+                make_thumbnails(filepath, [240, 120], self.storage)
+            for size in (240, 120):
+                with Image.open(self.storage.path(
+                        thumbnail_key(key, size))) as thumbnail:
+                    self.assertEqual(thumbnail.size, (size, size * 3 // 4))
+                    self.assertEqual(thumbnail.format, img_format)
+        with Image.open(self.storage.path(
+                thumbnail_key('alpha.png', 120))) as thumbnail:
+            self.assertEqual(thumbnail.mode, 'RGBA')
+            self.assertEqual(thumbnail.getpixel((0, 0))[3], 128)
+        with Image.open(self.storage.path(
+                thumbnail_key('deep.png', 120))) as thumbnail:
+            self.assertEqual(thumbnail.getpixel((0, 0)), 4000 // 256)
+
+    def test_picture_sources_and_derivatives(self):
+        formats = self.app.config['THUMBNAIL_FORMATS']
+        for key, mode in (('opaque.png', 'RGB'), ('alpha.png', 'RGBA')):
+            self.write_image(key, Image.new(mode, (1200, 900)), 'PNG')
+            with self.storage.local_path(key) as filepath:
+                make_thumbnails(filepath, [500, 240, 120], self.storage, formats)
+        url = '/photos/thumbnails/opaque_thumbnail{}.{}'.format
+        self.assertEqual(get_picture('opaque.png', 120), {
+            'src': url(120, 'png'),
+            'srcset': '{} 1x, {} 2x'.format(url(120, 'png'), url(240, 'png')),
+            'sources': [
+                {'type': 'image/webp', 'srcset': '{} 1x, {} 2x'.format(
+                    url(120, 'webp'), url(240, 'webp'))},
+                {'type': 'image/jpeg', 'srcset': '{} 1x, {} 2x'.format(
+                    url(120, 'jpg'), url(240, 'jpg'))}]})
+        self.assertEqual(get_picture('opaque.png', 500)['sources'][0]['srcset'],
+                         url(500, 'webp') + ' 1x')
+        self.assertFalse(self.storage.exists(thumbnail_key('alpha.png', 120,
+                                                           '.jpg')))
+        self.assertEqual([source['type'] for source in
+                          get_picture('alpha.png', 120)['sources']],
+                         ['image/webp'])
+
+
+class PhotoStoreCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.dir = tempfile.TemporaryDirectory()
+        self.app.storage = self.storage = FileSystemStorage(self.dir.name)
+        self.category = Category(name='TEST CATEGORY NAME')
+        db.session.add(self.category)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.dir.cleanup()
+
+    def image(self, color, img_format='PNG'):
+        f = tempfile.TemporaryFile()
+        Image.new('RGB', (200, 150), color).save(f, format=img_format)
+        f.seek(0)
+        return f
+
+    def test_identical_uploads_share_one_file(self):
+        with self.image('red') as first, self.image('red') as second, \
+                self.image('blue', 'JPEG') as third:
+            photo_id = store_photo(first, 'first.png')
+            self.assertEqual(store_photo(second, 'second.PNG'), photo_id)
+            other_id = store_photo(third)
+        self.assertRegex(photo_id, r'^[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}\.png$')
+        self.assertTrue(other_id.endswith('.jpg'))
+        files = [name for path, dirs, names in os.walk(self.dir.name)
+                 for name in names if '_thumbnail' not in name]
+        self.assertEqual(len(files), 2)
+        self.assertTrue(self.storage.exists(thumbnail_key(photo_id, 120)))
+
+    def test_photo_is_deleted_with_its_last_reference(self):
+        with self.image('red') as f:
+            photo_id = store_photo(f, 'photo.png')
+        items = [Item(title='ITEM {}'.format(i), photo_id=photo_id,
+                      category_id=self.category.id) for i in range(2)]
+        db.session.add_all(items)
+        db.session.commit()
+        release_photo(photo_id)
+        db.session.delete(items[0])
+        db.session.commit()
+        self.assertTrue(self.storage.exists(photo_id))
+        release_photo(photo_id)
+        db.session.delete(items[1])
+        db.session.rollback()
+        self.assertTrue(self.storage.exists(photo_id))
+        release_photo(photo_id)
+        items[1].photo_id = None
+        db.session.add(Item(title='NEW ITEM', photo_id=photo_id,
+                            category_id=self.category.id))
+        db.session.commit()
+        self.assertTrue(self.storage.exists(photo_id))
+        release_photo(photo_id)
+        Item.query.filter_by(title='NEW ITEM').delete()
+        db.session.commit()
+        self.assertFalse(self.storage.exists(photo_id))
+        self.assertFalse(self.storage.exists(thumbnail_key(photo_id, 120)))
+
+    def test_migrate_legacy_photos(self):
+        with tempfile.TemporaryDirectory() as source:
+            legacy = FileSystemStorage(source)
+            with self.image('red') as f:
+                legacy.save(f, 'apple.png')
+            db.session.add_all([
+                Item(title='ITEM', photo_id='apple.png',
+                     category_id=self.category.id),
+                Item(title='OTHER', photo_id='missing.png',
+                     category_id=self.category.id)])
+            self.category.photo_id = 'apple.png'
+            db.session.commit()
+            cli.register(self.app)
+            result = self.app.test_cli_runner().invoke(
+                args=['photos', 'migrate', '--source', source])
+            self.assertEqual(result.output.splitlines(), [
+                'Missing photo file: missing.png', 'Migrated 1 photos.'])
+            self.assertFalse(legacy.exists('apple.png'))
+        photo_id = Item.query.filter_by(title='ITEM').one().photo_id
+        self.assertEqual(Category.query.one().photo_id, photo_id)
+        self.assertTrue(self.storage.exists(photo_id))
+        self.assertTrue(self.storage.exists(thumbnail_key(photo_id, 120)))
+        self.assertEqual(Item.query.filter_by(title='OTHER').one().photo_id,
+                         'missing.png')
+
+
+class StubClientError(Exception):
+    def __init__(self, code):
+        super(StubClientError, self).__init__(code)
+        self.response = {'Error': {'Code': code}}
+
+
+class StubS3Client(object):
+    exceptions = SimpleNamespace(ClientError=StubClientError)
+
+    def __init__(self):
+        self.objects = {}
+        self.heads = 0
+
+    def upload_fileobj(self, stream, bucket, key, ExtraArgs=None):
+        self.objects[bucket, key] = stream.read()
+
+    def head_object(self, Bucket, Key):
+        self.heads += 1
+        if (Bucket, Key) not in self.objects:
+            raise StubClientError('404')
+        return {'ETag': '"{}"'.format(hashlib.md5(
+            self.objects[Bucket, Key]).hexdigest())}
+
+    def get_object(self, Bucket, Key):
+        return {'Body': io.BytesIO(self.objects[Bucket, Key])}
+
+    def download_fileobj(self, bucket, key, f):
+        f.write(self.objects[bucket, key])
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+
+    def generate_presigned_url(self, operation, Params, ExpiresIn):
+        return 'https://s3.example.com/{Bucket}/{Key}?expires={0}'.format(
+            ExpiresIn, **Params)
+
+
+class S3StorageCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.context = self.app.test_request_context()
+        self.context.push()
+        self.client = StubS3Client()
+        # Two web nodes sharing one bucket, each with its own HEAD cache.
+        self.nodes = [S3Storage('photos', prefix='cms/', head_cache_ttl=60)
+                      for _ in range(2)]
+        for node in self.nodes:
+            node._client = self.client
+
+    def tearDown(self):
+        self.context.pop()
+
+    def upload(self, storage):
+        f = io.BytesIO()
+        Image.new('RGB', (300, 200), 'red').save(f, format='PNG')
+        f.seek(0)
+        return store_photo(f, 'photo.png', storage)
+
+    def test_store_and_serve_photos(self):
+        first, second = self.nodes
+        photo_id = self.upload(first)
+        self.assertIn(('photos', 'cms/' + photo_id), self.client.objects)
+        self.assertIn(('photos', 'cms/' + thumbnail_key(photo_id, 120, '.webp')),
+                      self.client.objects)
+        self.assertTrue(second.exists(photo_id))
+        heads = self.client.heads
+        self.assertTrue(second.exists(photo_id))
+        version = second.version(photo_id)
+        self.assertEqual(self.client.heads, heads)
+        self.assertEqual(version, first.version(photo_id))
+        self.app.storage = second
+        self.assertEqual(
+            get_thumbnail(photo_id, 120),
+            'https://s3.example.com/photos/cms/{}?expires=3600'.format(
+                thumbnail_key(photo_id, 120)))
+        with second.open(photo_id) as f:
+            self.assertEqual(Image.open(f).size, (300, 200))
+
+    def test_upload_after_delete_on_another_node(self):
+        first, second = self.nodes
+        photo_id = self.upload(first)
+        self.assertTrue(second.exists(photo_id))
+        delete_photo(photo_id, first)
+        self.assertNotIn(('photos', 'cms/' + photo_id), self.client.objects)
+        self.assertEqual(self.upload(second), photo_id)
+        self.assertIn(('photos', 'cms/' + photo_id), self.client.objects)
+        self.assertTrue(first.exists(thumbnail_key(photo_id, 120)))
+        delete_photo(photo_id, first)
+        self.assertTrue(second.exists(photo_id))
+        self.assertFalse(second.exists(photo_id, cached=False))
+        self.assertFalse(second.exists(photo_id))
+
+    def test_missing_thumbnails_are_cached_briefly(self):
+        first, second = self.nodes
+        f = io.BytesIO()
+        Image.new('RGB', (300, 200), 'blue').save(f, format='PNG')
+        f.seek(0)
+        photo_id = 'aa/bb/' + 'ab' * 32 + '.png'
+        first.save(f, photo_id)
+        key = thumbnail_key(photo_id, 120)
+        heads = self.client.heads
+        second.miss_cache_ttl = 0
+        self.assertFalse(second.exists(key))
+        self.assertFalse(second.exists(key))
+        self.assertEqual(self.client.heads, heads + 2)
+        second.miss_cache_ttl = 60
+        self.assertFalse(second.exists(key))
+        self.assertFalse(second.exists(key))
+        self.assertEqual(self.client.heads, heads + 3)
+        # A pool worker writes the thumbnails through its own copy of the
+        # storage; the completion report clears this process's misses.
+        generate_thumbnails(photo_id, first, [500, 120])
+        self.assertFalse(second.exists(key))
+        ThumbnailQueue()._report(photo_id, second, None)
+        self.assertTrue(second.exists(key))
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)